@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# Headless throughput check for the data channel file transfer in
+# webrtc_server2.py: runs FILE_TRANSFER_JS under node against a pair of
+# simulated data channels and reports MB/s.
+#
+#   python3 transfer_bench.py --size-mb 64 --channels 4 --link-mbps 200
+#   python3 transfer_bench.py --interrupt 0.5   # drop the link half way, resume
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from webrtc_server2 import FILE_TRANSFER_JS
+
+
+BENCH_JS = '''
+// Simulated RTCDataChannel: send() queues into bufferedAmount, the link
+// delivers queued messages to the peer at the configured rate.
+class FakeChannel extends EventTarget {
+  constructor(link) {
+    super();
+    this.link = link;
+    this.peer = null;
+    this.queue = [];
+    this.readyState = "open";
+    this.bufferedAmount = 0;
+    this.bufferedAmountLowThreshold = 0;
+    this.binaryType = "arraybuffer";
+    this.maxBuffered = 0;
+    link.channels.push(this);
+  }
+
+  send(data) {
+    if (this.readyState !== "open") {
+      throw new Error("channel is " + this.readyState);
+    }
+    const size = typeof data === "string" ? data.length : data.byteLength;
+    this.queue.push({data: data, size: size});
+    this.bufferedAmount += size;
+    this.maxBuffered = Math.max(this.maxBuffered, this.bufferedAmount);
+    this.link.schedule();
+  }
+
+  deliverOne() {
+    const message = this.queue.shift();
+    const before = this.bufferedAmount;
+    this.bufferedAmount -= message.size;
+    if (this.link.corrupt && typeof message.data !== "string" && Math.random() < this.link.corrupt) {
+      new Uint8Array(message.data)[message.data.byteLength - 1] ^= 0xff;
+    }
+    const event = new Event("message");
+    event.data = message.data;
+    this.peer.dispatchEvent(event);
+    if (before > this.bufferedAmountLowThreshold &&
+        this.bufferedAmount <= this.bufferedAmountLowThreshold) {
+      this.dispatchEvent(new Event("bufferedamountlow"));
+    }
+    return message.size;
+  }
+
+  close() {
+    this.readyState = "closed";
+    this.queue = [];
+    this.bufferedAmount = 0;
+    this.dispatchEvent(new Event("close"));
+  }
+}
+
+// Link capacity accrues as byte credit over time and carries over between
+// pumps; a message is only delivered once there is credit for all of it.
+// bytesPerMs 0 means unlimited.
+class FakeLink {
+  constructor(bytesPerMs, corrupt) {
+    this.bytesPerMs = bytesPerMs;
+    this.corrupt = corrupt;
+    this.channels = [];
+    this.scheduled = false;
+    this.idle = true;
+    this.credit = 0;
+    this.lastPump = 0;
+    // Enough for the largest chunk plus ~10 ms of traffic after a pause.
+    this.maxCredit = bytesPerMs * 10 + 65536 + 1024;
+    this.delivered = 0;
+    this.dropAfter = Infinity;
+  }
+
+  schedule() {
+    if (!this.scheduled) {
+      if (this.idle) {
+        this.lastPump = performance.now();
+        this.idle = false;
+      }
+      this.scheduled = true;
+      setTimeout(() => this.pump(), this.bytesPerMs ? 1 : 0);
+    }
+  }
+
+  pump() {
+    this.scheduled = false;
+    const now = performance.now();
+    if (this.bytesPerMs) {
+      this.credit = Math.min(this.credit + (now - this.lastPump) * this.bytesPerMs, this.maxCredit);
+    } else {
+      this.credit = Infinity;
+    }
+    this.lastPump = now;
+
+    // One message per channel per round, like SCTP streams sharing the link.
+    let progress = true;
+    while (progress) {
+      progress = false;
+      for (const channel of this.channels) {
+        if (channel.readyState !== "open" || !channel.queue.length ||
+            channel.queue[0].size > this.credit) {
+          continue;
+        }
+        const size = channel.deliverOne();
+        this.credit -= size;
+        this.delivered += size;
+        progress = true;
+        if (this.delivered >= this.dropAfter) {
+          this.dropAfter = Infinity;
+          for (const c of this.channels) {
+            c.close();
+          }
+          return;
+        }
+      }
+    }
+    if (this.channels.some((c) => c.readyState === "open" && c.queue.length)) {
+      this.schedule();
+    } else {
+      this.idle = true;
+      this.credit = 0;
+    }
+  }
+}
+
+function channel_pair(link) {
+  const a = new FakeChannel(link);
+  const b = new FakeChannel(link);
+  a.peer = b;
+  b.peer = a;
+  return [a, b];
+}
+
+function connect(link, channelCount) {
+  const [controlA, controlB] = channel_pair(link);
+  const dataA = [];
+  const dataB = [];
+  for (let i = 0; i < channelCount; i++) {
+    const [a, b] = channel_pair(link);
+    dataA.push(a);
+    dataB.push(b);
+  }
+  return [controlA, dataA, controlB, dataB];
+}
+
+async function main(options) {
+  const size = options.sizeMb * 1024 * 1024;
+  const data = new Uint8Array(size);
+  for (let offset = 0; offset < size; offset += 65536) {
+    crypto.getRandomValues(data.subarray(offset, Math.min(offset + 65536, size)));
+  }
+  const file = new Blob([data]);
+  file.name = "bench.bin";
+  file.lastModified = 0;
+
+  const link = new FakeLink(options.linkMbps * 1000 * 1000 / 8 / 1000, options.corrupt);
+  let [controlA, dataA, controlB, dataB] = connect(link, options.channels);
+  const sender = new FileTransfer(controlA, dataA, options.maxMessageSize);
+  const receiver = new FileTransfer(controlB, dataB, options.maxMessageSize);
+  const received = new Promise((resolve) => receiver.onfile = resolve);
+
+  const started = performance.now();
+  let sent = 0;
+  if (options.interrupt) {
+    link.dropAfter = size * options.interrupt;
+    try {
+      await sender.send(file);
+    } catch (error) {
+      console.log("interrupted:", error.message);
+    }
+    // Reconnect with fresh channels but keep the receiver's partial state.
+    const link2 = new FakeLink(link.bytesPerMs, options.corrupt);
+    [controlA, dataA, controlB, dataB] = connect(link2, options.channels);
+    const resumedSender = new FileTransfer(controlA, dataA, options.maxMessageSize);
+    const resumedReceiver = new FileTransfer(controlB, dataB, options.maxMessageSize);
+    resumedReceiver.incomingByKey = receiver.incomingByKey;
+    resumedReceiver.onfile = receiver.onfile;
+    sent = (await resumedSender.send(file)).sent;
+    console.log("resumed, re-sent bytes:", sent);
+  } else {
+    sent = (await sender.send(file)).sent;
+  }
+  const blob = await received;
+  const seconds = (performance.now() - started) / 1000;
+
+  const ok = Buffer.compare(Buffer.from(await blob.arrayBuffer()), Buffer.from(data)) === 0;
+  const maxBuffered = Math.max(...dataA.map((c) => c.maxBuffered));
+  console.log("chunk size:", sender.chunkSize, "channels:", options.channels);
+  console.log("max bufferedAmount per channel:", maxBuffered);
+  console.log("transferred", options.sizeMb, "MB in", seconds.toFixed(3), "s:",
+              (options.sizeMb / seconds).toFixed(2), "MB/s", ok ? "(verified)" : "(MISMATCH)");
+  process.exit(ok ? 0 : 1);
+}
+
+main(JSON.parse(process.argv[2]));
+'''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure data channel file transfer throughput.')
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--max-message-size', type=int, default=262144)
+    parser.add_argument('--link-mbps', type=float, default=0, help='0 means unlimited')
+    parser.add_argument('--corrupt', type=float, default=0, help='fraction of chunks to corrupt')
+    parser.add_argument('--interrupt', type=float, default=0,
+                        help='drop the link after this fraction of the file, then resume')
+    parser.add_argument('--node', default='node')
+    args = parser.parse_args()
+
+    options = {
+        'sizeMb': args.size_mb,
+        'channels': args.channels,
+        'maxMessageSize': args.max_message_size,
+        'linkMbps': args.link_mbps,
+        'corrupt': args.corrupt,
+        'interrupt': args.interrupt,
+    }
+    with tempfile.NamedTemporaryFile('w', suffix='.js', delete=False) as f:
+        f.write(FILE_TRANSFER_JS + BENCH_JS)
+    try:
+        result = subprocess.run([args.node, f.name, json.dumps(options)])
+    finally:
+        os.unlink(f.name)
+    sys.exit(result.returncode)
+
+
+if __name__ == '__main__':
+    main()
@@ -20,9 +20,34 @@
 # https://aiortc.readthedocs.io
 # https://github.com/aiortc/aiortc
 
+from array import array
+from collections import OrderedDict
 from http.server import HTTPServer, HTTPStatus, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlsplit
+import bisect
+import gc
+import hashlib
+import heapq
+import http.client
+import itertools
 import json
+import math
+import mmap
+import os
+import re
+import resource
+import secrets
+import signal
+import socket
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
 
 
 #############
@@ -54,8 +79,11 @@ BASE_TEMPLATE = '''
 <script type="text/javascript">
 'use strict';
 
-const rtc_peer_configuration = {iceServers: [{urls: 'stun:stun.l.google.com:19302'}]}; //change this later
-// const rtc_peer_configuration = {iceServers: []};
+const rtc_peer_configuration = %s;
+
+// Room and client id assigned by the server's matchmaking.
+const roomId = %s;
+const clientId = %s;
 
 // Define helper functions.
 
@@ -67,6 +95,63 @@ function trace(text) {
   console.log(now, text);
 }
 
+// Define call setup tracing. Span times are epoch milliseconds so the server
+// can line them up with its own request timings.
+const traceId = %s;
+
+let traceSpans = [];
+let traceFlushTimer = null;
+
+function spanNow() {
+  return window.performance.timeOrigin + window.performance.now();
+}
+
+function recordSpan(name, start, end) {
+  traceSpans.push({"name": name, "start": start, "end": end === undefined ? spanNow() : end});
+  if (traceFlushTimer === null) {
+    traceFlushTimer = setTimeout(flushTrace, 2000);
+  }
+}
+
+// Records the time until the promise resolves as one span.
+function traced(name, promise) {
+  const start = spanNow();
+  return promise.then((result) => {
+    recordSpan(name, start);
+    return result;
+  });
+}
+
+// Bodies smaller than this don't shrink enough to pay for the gzip framing.
+const compressMinSize = 512;
+
+function postJson(url, body, options) {
+  const headers = {"Content-Type": "application/json; charset=utf-8", "X-Trace-Id": traceId};
+  let payload = Promise.resolve(body);
+  if (window.CompressionStream && body.length >= compressMinSize) {
+    headers["Content-Encoding"] = "gzip";
+    const stream = new Blob([body]).stream().pipeThrough(new CompressionStream('gzip'));
+    payload = new Response(stream).blob();
+  }
+  return payload.then((data) => fetch(url, {method: "POST", headers: headers, body: data, ...options}));
+}
+
+// Uploads the pending spans in one request.
+function flushTrace() {
+  clearTimeout(traceFlushTimer);
+  traceFlushTimer = null;
+  if (traceSpans.length === 0) {
+    return;
+  }
+  const body = JSON.stringify({"trace": traceId, "room": roomId, "id": clientId, "spans": traceSpans});
+  traceSpans = [];
+  postJson("/meet/trace", body, {keepalive: true}).catch((error) => {
+    trace(`Failed to send trace: ${error.toString()}.`);
+  });
+}
+
+window.addEventListener('pagehide', flushTrace);
+
 // In this codelab, you will be streaming video only: "video: true".
 // Audio will not be streamed because it is set to "audio: false" by default.
 const mediaStreamConstraints = {
@@ -138,6 +223,8 @@ function logResizedVideo(event) {
 
   if (startTime) {
     const elapsedTime = window.performance.now() - startTime;
+    recordSpan('first_frame', window.performance.timeOrigin + startTime);
+    flushTrace();
     startTime = null;
     trace(`Setup time: ${elapsedTime.toFixed(3)}ms.`);
   }
@@ -145,7 +232,7 @@ function logResizedVideo(event) {
 
 localVideo.addEventListener('loadedmetadata', logVideoLoaded);
 remoteVideo.addEventListener('loadedmetadata', logVideoLoaded);
-remoteVideo.addEventListener('onresize', logResizedVideo);
+remoteVideo.addEventListener('resize', logResizedVideo);
 
 // Define RTC peer connection behavior.
 
@@ -154,6 +241,320 @@ function handleConnectionChange(event) {
   const peerConnection = event.target;
   console.log('ICE state change event: ', event);
   trace("ICE state: " + peerConnection.iceConnectionState);
+  if (peerConnection.iceConnectionState === 'connected') {
+    if (startTime) {
+      recordSpan('ice_connected', window.performance.timeOrigin + startTime);
+    }
+    startStatsReporting();
+  }
+}
+
+let iceGatheringStart = null;
+
+// Traces ICE gathering from its start until all candidates are known.
+function handleGatheringChange(event) {
+  const state = event.target.iceGatheringState;
+  if (state === 'gathering') {
+    iceGatheringStart = spanNow();
+  } else if (state === 'complete' && iceGatheringStart !== null) {
+    recordSpan('ice_gathering', iceGatheringStart);
+    iceGatheringStart = null;
+  }
+  if (state === 'complete' && pendingCandidates.length > 0) {
+    sendSignal([]);
+  }
+}
+
+// Define batched signaling: one POST carries our pending operations, an ack
+// for the updates already handled and a fetch for everything newer.
+let signalCursor = 0;
+let pendingCandidates = [];
+let remoteDescriptionSet = false;
+let queuedRemoteCandidates = [];
+
+function sendSignal(ops) {
+  if (pendingCandidates.length > 0) {
+    ops.push({"op": "candidates", "candidates": pendingCandidates});
+    pendingCandidates = [];
+  }
+  ops.push({"op": "ack", "cursor": signalCursor}, {"op": "fetch"});
+
+  const body = JSON.stringify({"room": roomId, "id": clientId, "ops": ops});
+  return postJson("/meet/batch", body).then((response) => response.json())
+    .then((data) => {
+      for (const update of data.updates) {
+        if (update.seq > signalCursor) {
+          handlePeerUpdate(update);
+        }
+      }
+      signalCursor = Math.max(signalCursor, data.cursor);
+      return data;
+    }).catch((error) => {
+      trace(`Signaling error: ${error.toString()}.`);
+    });
+}
+
+let remoteOfferResolver = null;
+
+function handlePeerUpdate(update) {
+  if (update.type === 'offer' && remoteOfferResolver !== null) {
+    remoteOfferResolver(update.data);
+    remoteOfferResolver = null;
+  } else if (update.type === 'offer' && !remoteDescriptionSet) {
+    setRemoteDescription(update.data);
+  } else if (update.type === 'candidates') {
+    addRemoteCandidates(update.data);
+  }
+}
+
+function setRemoteDescription(description) {
+  remoteDescriptionSet = true;
+  return traced('setRemoteDescription', localPeerConnection.setRemoteDescription(description))
+    .then(() => {
+      trace('set the remote description');
+      const candidates = queuedRemoteCandidates;
+      queuedRemoteCandidates = [];
+      addRemoteCandidates(candidates);
+    }).catch(setSessionDescriptionError);
+}
+
+// Candidates can only be added once the remote description is in place.
+function addRemoteCandidates(candidates) {
+  if (!localPeerConnection || !localPeerConnection.remoteDescription) {
+    queuedRemoteCandidates.push(...candidates);
+    return;
+  }
+  for (const candidate of candidates) {
+    localPeerConnection.addIceCandidate(candidate)
+      .then(() => {
+        trace("addIceCandidate success");
+      }).catch((error) => {
+        trace("failed to add ICE Candidate:" + error.toString());
+      });
+  }
+}
+
+// Define pre-warming: the peer connection is created, negotiated and starts
+// ICE gathering on page load with empty senders. The description is parked
+// on the server and only published when the user clicks.
+let prewarmed = null;
+
+function createPeerConnection() {
+  localPeerConnection = new RTCPeerConnection(rtc_peer_configuration);
+  remoteDescriptionSet = false;
+
+  localPeerConnection.addEventListener('icecandidate', handleConnection);
+  localPeerConnection.addEventListener(
+    'iceconnectionstatechange', handleConnectionChange);
+  localPeerConnection.addEventListener(
+    'icegatheringstatechange', handleGatheringChange);
+  localPeerConnection.addEventListener("track", gotRemoteTrack);
+}
+
+// Parks a provisional description in the server's warm pool.
+function warmDescription(description) {
+  traced('setLocalDescription', localPeerConnection.setLocalDescription(description))
+    .then(() => {}).catch(setSessionDescriptionError);
+  return sendSignal([{"op": "warm", "offer": description}]);
+}
+
+// Puts the local tracks on the already negotiated senders; no renegotiation.
+function attachLocalTracks() {
+  for (const track of localStream.getTracks()) {
+    const transceiver = localPeerConnection.getTransceivers().find(
+      (t) => t.receiver.track.kind === track.kind && !t.sender.track);
+    if (!transceiver) {
+      trace(`no pre-negotiated sender for ${track.kind} track`);
+      continue;
+    }
+    trace('adding localStream track to peer connection');
+    transceiver.sender.replaceTrack(track);
+    if (transceiver.sender.setStreams) {
+      transceiver.sender.setStreams(localStream);
+    }
+  }
+}
+
+// Polls while not connected. This also keeps the room alive so it stays in
+// the matchmaking pool while we wait for a peer.
+const signalPollInterval = 20000;
+
+setInterval(() => {
+  if (!localPeerConnection || localPeerConnection.iceConnectionState !== 'connected') {
+    sendSignal([]);
+  }
+}, signalPollInterval);
+
+// Once our description is out, the peer's answer and candidates are what
+// the call waits on: poll for them quickly until connected.
+const signalFastPollInterval = 500;
+const signalFastPollTimeout = 60000;
+
+function pollUntilConnected() {
+  const deadline = Date.now() + signalFastPollTimeout;
+  const poll = () => {
+    const state = localPeerConnection ? localPeerConnection.iceConnectionState : 'closed';
+    if (state === 'connected' || state === 'completed' || state === 'closed' || Date.now() > deadline) {
+      return;
+    }
+    sendSignal([]).then(() => setTimeout(poll, signalFastPollInterval));
+  };
+  setTimeout(poll, signalFastPollInterval);
+}
+
+// Publishes the parked description; if its warm slot has expired, posts the
+// description itself instead.
+function commitDescription() {
+  return sendSignal([{"op": "commit"}])
+    .then((data) => {
+      if (data && !data.committed) {
+        return sendSignal([{"op": "offer", "offer": localPeerConnection.localDescription}]);
+      }
+      return data;
+    }).then((data) => {
+      pollUntilConnected();
+      return data;
+    });
+}
+
+// Define call quality reporting.
+
+const statsInterval = 1000;
+const statsBatchSize = 5;
+
+let statsTimer = null;
+let statsBatch = [];
+let lastInboundStats = null;
+let lastOutboundStats = null;
+
+// Collects one sample (RTT, jitter, packet loss, bitrate, decoded frames) from
+// getStats(); cumulative counters are turned into per-interval deltas.
+function collectStats() {
+  if (!localPeerConnection) {
+    return;
+  }
+  localPeerConnection.getStats().then((report) => {
+    const sample = {t: Date.now() / 1000};
+    let inbound = null;
+    let outbound = null;
+    report.forEach((stat) => {
+      if (stat.type === 'candidate-pair' && stat.nominated) {
+        if (stat.currentRoundTripTime !== undefined) {
+          sample.rtt = stat.currentRoundTripTime * 1000;
+        }
+        if (stat.availableOutgoingBitrate !== undefined) {
+          sample.available_bitrate = stat.availableOutgoingBitrate;
+        }
+      } else if (stat.type === 'inbound-rtp' && stat.kind === 'video') {
+        inbound = stat;
+        if (stat.jitter !== undefined) {
+          sample.jitter = stat.jitter * 1000;
+        }
+      } else if (stat.type === 'outbound-rtp' && stat.kind === 'video') {
+        outbound = stat;
+      } else if (stat.type === 'remote-inbound-rtp' && stat.kind === 'video') {
+        // What the remote peer reports about the stream we send.
+        if (stat.fractionLost !== undefined) {
+          sample.send_loss = stat.fractionLost;
+        }
+      }
+    });
+    if (outbound && lastOutboundStats) {
+      const seconds = (outbound.timestamp - lastOutboundStats.timestamp) / 1000;
+      if (seconds > 0) {
+        sample.send_bitrate = 8 * (outbound.bytesSent - lastOutboundStats.bytesSent) / seconds;
+      }
+    }
+    lastOutboundStats = outbound;
+    if (inbound && lastInboundStats) {
+      const seconds = (inbound.timestamp - lastInboundStats.timestamp) / 1000;
+      const received = inbound.packetsReceived - lastInboundStats.packetsReceived;
+      const lost = Math.max(inbound.packetsLost - lastInboundStats.packetsLost, 0);
+      if (received + lost > 0) {
+        sample.packet_loss = lost / (received + lost);
+      }
+      if (seconds > 0) {
+        sample.bitrate = 8 * (inbound.bytesReceived - lastInboundStats.bytesReceived) / seconds;
+      }
+      sample.frames_decoded = inbound.framesDecoded - lastInboundStats.framesDecoded;
+    }
+    lastInboundStats = inbound;
+    statsBatch.push(sample);
+    if (statsBatch.length >= statsBatchSize) {
+      flushStats();
+    }
+  }).catch((error) => {
+    trace(`getStats error: ${error.toString()}.`);
+  });
+}
+
+// Posts the pending samples in one request, gzipped when the browser supports it.
+function flushStats() {
+  if (statsBatch.length === 0) {
+    return;
+  }
+  const body = JSON.stringify({"call": roomId, "id": clientId, "samples": statsBatch});
+  statsBatch = [];
+
+  postJson("/meet/stats", body, {keepalive: true})
+    .then((response) => response.status === 200 ? response.json() : null)
+    .then((data) => {
+      if (data && data.recommendation) {
+        applyRecommendation(data.recommendation);
+      }
+    })
+    .catch((error) => {
+      trace(`Failed to send stats: ${error.toString()}.`);
+    });
+}
+
+function startStatsReporting() {
+  if (statsTimer === null) {
+    statsTimer = setInterval(collectStats, statsInterval);
+  }
+}
+
+function stopStatsReporting() {
+  if (statsTimer !== null) {
+    clearInterval(statsTimer);
+    statsTimer = null;
+  }
+  flushStats();
+  lastInboundStats = null;
+  lastOutboundStats = null;
+}
+
+// Applies the server's bitrate/resolution/framerate target to the video sender.
+function applyRecommendation(recommendation) {
+  if (!localPeerConnection) {
+    return;
+  }
+  const sender = localPeerConnection.getSenders().find(
+    (s) => s.track && s.track.kind === 'video');
+  if (!sender) {
+    return;
+  }
+  const parameters = sender.getParameters();
+  if (!parameters.encodings || parameters.encodings.length === 0) {
+    parameters.encodings = [{}];
+  }
+  for (const encoding of parameters.encodings) {
+    // null lifts the limit again.
+    if (recommendation.bitrate === null) {
+      delete encoding.maxBitrate;
+      delete encoding.maxFramerate;
+    } else {
+      encoding.maxBitrate = recommendation.bitrate;
+      encoding.maxFramerate = recommendation.max_framerate;
+    }
+    encoding.scaleResolutionDownBy = recommendation.scale_resolution_down_by;
+  }
+  sender.setParameters(parameters)
+    .then(() => {
+      trace(`Applied target bitrate ${recommendation.bitrate || 'unlimited'}bps.`);
+    }).catch((error) => {
+      trace(`setParameters error: ${error.toString()}.`);
+    });
 }
 
 // Logs error when setting session description fails.
@@ -164,13 +565,14 @@ function setSessionDescriptionError(error) {
 // Handles start button action: creates local MediaStream.
 function startAction() {
   startButton.disabled = true;
-  navigator.mediaDevices.getUserMedia(mediaStreamConstraints)
+  traced('getUserMedia', navigator.mediaDevices.getUserMedia(mediaStreamConstraints))
     .then(gotLocalMediaStream).catch(handleLocalMediaStreamError);
   // trace('Requesting local stream.');
 }
 
 // Handles hangup action: ends up call, closes connections and resets peers.
 function hangupAction() {
+  stopStatsReporting();
   localPeerConnection.close();
   localPeerConnection = null;
   hangupButton.disabled = true;
@@ -214,54 +616,30 @@ const hangupButton = document.getElementById('hangupButton');
 connectButton.disabled = true;
 hangupButton.disabled = true;
 
-// Define Client ID (different for different page loads)
-let clientId = 1;
-
-// ** store the iceCandidate here, and then add it on a button event!
-let iceCandidate;
-
-// Connects with new peer candidate.
+// Queues new local candidates; they go out with the next signaling batch.
 function handleConnection(event) {
   console.log("handleConnection start");
-  // const peerConnection = event.target;
-  iceCandidate = event.candidate;
-
-  // if (iceCandidate) {
-  //   console.log("  ice candidate");
-  //   const newIceCandidate = new RTCIceCandidate(iceCandidate);
-  //   localPeerConnection.addIceCandidate(newIceCandidate)
-  //     .then(() => {
-  //       trace("addIceCandidate success");
-  //     }).catch((error) => {
-  //       trace("failed to add ICE Candidate:" + error.toString());
-  //     });
-
-  //   trace("ICE candidate:" + event.candidate.candidate);
-  // }
+  if (event.candidate) {
+    pendingCandidates.push(event.candidate.toJSON());
+    trace("ICE candidate:" + event.candidate.candidate);
+  }
   console.log("handleConnection end");
 }
-// Logs offer creation and sets local peer connection session descriptions;
-// posts offer data to server
-function createdOffer(description) {
-  // trace('localPeerConnection setLocalDescription start.');
-  localPeerConnection.setLocalDescription(description)
-    .then(() => {}).catch(setSessionDescriptionError);
+// Creates the peer connection and a provisional offer before the user acts.
+function prewarm() {
+  createPeerConnection();
+  localPeerConnection.addTransceiver('video', {direction: 'sendrecv'});
 
-  const xhr = new XMLHttpRequest();
-  xhr.open("POST", "/meet", true);
-  // Send the proper header information along with the request
-  xhr.setRequestHeader("Content-Type", "application/json; charset=utf-8");
-  xhr.onreadystatechange = () => {
-    // Call a function when the state changes.
-    if (xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {
-      // Request finished. Do processing here.
-      console.log("posted offer");
-    }
-  };
-  xhr.send(JSON.stringify({"id": clientId, "offer": description}));
+  // trace('localPeerConnection createOffer start.');
+  return traced('createOffer', localPeerConnection.createOffer(offerOptions))
+    .then(warmDescription)
+    .then(() => {
+      console.log("posted provisional offer");
+    }).catch(setSessionDescriptionError);
 }
 
-// Handles call button action: creates peer connection.
+// Handles call button action: sends local media over the pre-warmed
+// connection and publishes the offer.
 function connectAction() {
   connectButton.disabled = true;
   hangupButton.disabled = false;
@@ -269,6 +647,10 @@ function connectAction() {
   trace('Starting call.');
   startTime = window.performance.now();
 
+  if (!localPeerConnection) {
+    prewarmed = prewarm();
+  }
+
   // Get local media stream tracks.
   // const videoTracks = localStream.getVideoTracks();
   // const audioTracks = localStream.getAudioTracks();
@@ -279,56 +661,23 @@ function connectAction() {
   //   // trace(`Using audio device: ${audioTracks[0].label}.`);
   // }
 
-  // Create peer connections and add behavior.
-  localPeerConnection = new RTCPeerConnection(rtc_peer_configuration);
-  // trace('Created local peer connection object localPeerConnection.');
-
-  localPeerConnection.addEventListener('icecandidate', handleConnection);
-  localPeerConnection.addEventListener(
-    'iceconnectionstatechange', handleConnectionChange);
-
-  localPeerConnection.addEventListener("track", gotRemoteTrack);
-
-  // Add local stream to connection and create offer to connect.
-  // localPeerConnection.addStream(localStream);
-  // trace('Added local stream to localPeerConnection.');
-  for (const track of localStream.getTracks()) {
-    trace('adding localStream track to peer connection');
-    localPeerConnection.addTrack(track, localStream);
-  }
-
-  // trace('localPeerConnection createOffer start.');
-  localPeerConnection.createOffer(offerOptions)
-    .then(createdOffer).catch(setSessionDescriptionError);
+  prewarmed
+    .then(() => {
+      attachLocalTracks();
+      return commitDescription();
+    }).then(() => {
+      console.log("posted offer");
+    });
 }
 
-// Handles call button action: creates peer connection.
+// Handles get remote button action: fetches the answer and candidates.
 function getRemoteAction() {
-  const xhr = new XMLHttpRequest();
-  xhr.open("GET", "/meet/" + clientId, true);
-  // Send the proper header information along with the request
-  xhr.setRequestHeader("Content-Type", "application/json; charset=utf-8");
-  xhr.onreadystatechange = () => {
-    // Call a function when the state changes.
-    if (xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {
-      // Request finished. Do processing here.
-      console.log("got remote description: " + xhr.responseText);
-      trace('start setting remote description for other client');
-      localPeerConnection.setRemoteDescription(JSON.parse(xhr.responseText))
-        .then(() => {
-            trace('finished setting remote description - adding ice candidate...');
-            const newIceCandidate = new RTCIceCandidate(iceCandidate);
-            localPeerConnection.addIceCandidate(newIceCandidate)
-              .then(() => {
-                trace("addIceCandidate success");
-              }).catch((error) => {
-                trace("failed to add ICE Candidate:" + error.toString());
-              });
-        })
-        .catch(setSessionDescriptionError);
-    }
-  };
-  xhr.send();
+  sendSignal([])
+    .then((data) => {
+      if (data) {
+        console.log("got " + data.updates.length + " remote updates");
+      }
+    });
 }
 
 // Add click event handlers for buttons.
@@ -336,6 +685,8 @@ startButton.addEventListener('click', startAction);
 connectButton.addEventListener('click', connectAction);
 getRemoteButton.addEventListener('click', getRemoteAction);
 hangupButton.addEventListener('click', hangupAction);
+
+prewarmed = prewarm();
 '''
 
 CLIENT_2_JS = '''
@@ -348,119 +699,1634 @@ const hangupButton = document.getElementById('hangupButton');
 connectButton.disabled = true;
 hangupButton.disabled = true;
 
-let clientId = 2;
-
 let hostOffer = %s;
 
-// Connects with new peer candidate.
+// Queues new local candidates; they go out with the next signaling batch.
 function handleConnection(event) {
   console.log("handleConnection start");
-  // const peerConnection = event.target;
-  const iceCandidate = event.candidate;
-
-  if (iceCandidate) {
-    console.log("  ice candidate");
-    const newIceCandidate = new RTCIceCandidate(iceCandidate);
-    localPeerConnection.addIceCandidate(newIceCandidate)
-      .then(() => {
-        trace("addIceCandidate success");
-      }).catch((error) => {
-        trace("failed to add ICE Candidate:" + error.toString());
-      });
-
+  if (event.candidate) {
+    pendingCandidates.push(event.candidate.toJSON());
     trace("ICE candidate:" + event.candidate.candidate);
   }
   console.log("handleConnection end");
 }
 
-function joinCall() {
-  // Get local media stream tracks.
-  // const videoTracks = localStream.getVideoTracks();
-  // const audioTracks = localStream.getAudioTracks();
-  // if (videoTracks.length > 0) {
-  //   // trace(`Using video device: ${videoTracks[0].label}.`);
-  // }
-  // if (audioTracks.length > 0) {
-  //   // trace(`Using audio device: ${audioTracks[0].label}.`);
-  // }
+// Resolves with the caller's offer, polling for it if the page was
+// rendered before the caller had one.
+function remoteOffer() {
+  if (hostOffer) {
+    return Promise.resolve(hostOffer);
+  }
+  return new Promise((resolve) => {
+    remoteOfferResolver = resolve;
+    const poll = () => {
+      if (remoteOfferResolver !== null) {
+        sendSignal([]).then(() => setTimeout(poll, 1000));
+      }
+    };
+    poll();
+  });
+}
 
-  // Create peer connections and add behavior.
-  localPeerConnection = new RTCPeerConnection(rtc_peer_configuration);
-  // trace('Created local peer connection object localPeerConnection.');
+// Creates the peer connection and a provisional answer before the user acts.
+function prewarm() {
+  createPeerConnection();
 
-  localPeerConnection.setRemoteDescription(hostOffer)
+  return remoteOffer()
+    .then((offer) => setRemoteDescription(offer))
     .then(() => {
-      trace('set the remote description');
+      for (const transceiver of localPeerConnection.getTransceivers()) {
+        transceiver.direction = 'sendrecv';
+      }
+      trace('createAnswer start.');
+      return traced('createAnswer', localPeerConnection.createAnswer());
+    })
+    .then(warmDescription)
+    .then(() => {
+      console.log("posted provisional answer");
     }).catch(setSessionDescriptionError);
+}
 
-  localPeerConnection.addEventListener('icecandidate', handleConnection);
-  localPeerConnection.addEventListener(
-    'iceconnectionstatechange', handleConnectionChange);
+function joinCall() {
+  connectButton.disabled = true;
+  hangupButton.disabled = false;
+  startTime = window.performance.now();
 
-  // Add local stream to connection and create offer to connect.
-  // localPeerConnection.addStream(localStream);
-  // trace('Added local stream to localPeerConnection.');
-  for (const track of localStream.getTracks()) {
-    trace('adding localStream track to peer connection');
-    localPeerConnection.addTrack(track, localStream);
+  if (!localPeerConnection) {
+    prewarmed = prewarm();
   }
-
-  localPeerConnection.addEventListener("track", gotRemoteTrack);
-
-  trace('createAnswer start.');
-  localPeerConnection.createAnswer()
-    .then(createdAnswer)
-    .catch(setSessionDescriptionError);
-}
-
-// Logs answer to offer creation and sets peer connection session descriptions.
-function createdAnswer(description) {
-  // trace('localPeerConnection setLocalDescription start.');
-  localPeerConnection.setLocalDescription(description)
-    .then(() => {}).catch(setSessionDescriptionError);
-  console.log("set local description to answer value");
-
-  const xhr = new XMLHttpRequest();
-  xhr.open("POST", "/meet", true);
-  // Send the proper header information along with the request
-  xhr.setRequestHeader("Content-Type", "application/json; charset=utf-8");
-  xhr.onreadystatechange = () => {
-    // Call a function when the state changes.
-    if (xhr.readyState === XMLHttpRequest.DONE && xhr.status === 200) {
-      // Request finished. Do processing here.
+  prewarmed
+    .then(() => {
+      attachLocalTracks();
+      return commitDescription();
+    }).then(() => {
       console.log("posted answer to server");
-    }
-  };
-  xhr.send(JSON.stringify({"id": clientId, "offer": description}));
+    });
 }
 
 // Add click event handlers for buttons.
 startButton.addEventListener('click', startAction);
 connectButton.addEventListener('click', joinCall);
 hangupButton.addEventListener('click', hangupAction);
+
+prewarmed = prewarm();
 '''
 
-CLIENT_1 = BASE_TEMPLATE % (CLIENT_1_HTML, CLIENT_1_JS)
+#########
+# STATS #
+#########
+STATS_METRICS = ('rtt', 'jitter', 'packet_loss', 'bitrate', 'frames_decoded')
+# (raw samples per slot, slots): ~2 minutes of 1s samples, ~20 minutes of 10s
+# means and ~2 hours of 1 minute means per metric, per call.
+STATS_TIERS = ((1, 120), (10, 120), (60, 120))
+STATS_MAX_CALLS = 1000
+STATS_IDLE_TIMEOUT = 300
+STATS_MAX_BODY = 64 * 1024
+STATS_MAX_DECODED_BODY = 1024 * 1024
+STATS_PATH = '/meet/stats'
+# Cluster nodes exchange values as histograms with logarithmic buckets this
+# far apart (see CLUSTER), which keeps fleet percentiles within 1%.
+HISTOGRAM_GROWTH = 1.02
+
+
+class RingBuffer:
+    def __init__(self, size):
+        self.values = array('d', bytes(8 * size))
+        self.times = array('d', bytes(8 * size))
+        self.size = size
+        self.count = 0
+        self.pos = 0
+
+    def append(self, timestamp, value):
+        self.times[self.pos] = timestamp
+        self.values[self.pos] = value
+        self.pos = (self.pos + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def items(self):
+        start = (self.pos - self.count) % self.size
+        for i in range(self.count):
+            j = (start + i) % self.size
+            yield self.times[j], self.values[j]
+
+    def latest(self):
+        if not self.count:
+            return None
+        return self.values[(self.pos - 1) % self.size]
+
+
+class TimeSeries:
+    # Each tier averages `factor` raw samples into one slot, so long calls
+    # keep coarse history without growing.
+    def __init__(self, tiers=STATS_TIERS):
+        self.tiers = [RingBuffer(size) for _, size in tiers]
+        self.factors = [factor for factor, _ in tiers]
+        self.sums = array('d', bytes(8 * len(tiers)))
+        self.counts = array('l', bytes(array('l').itemsize * len(tiers)))
+
+    def append(self, timestamp, value):
+        for i, factor in enumerate(self.factors):
+            self.sums[i] += value
+            self.counts[i] += 1
+            if self.counts[i] >= factor:
+                self.tiers[i].append(timestamp, self.sums[i] / self.counts[i])
+                self.sums[i] = 0.0
+                self.counts[i] = 0
+
+
+def is_finite_number(value):
+    # json.loads accepts NaN and Infinity, which would poison the sorts and
+    # can't be written back out as JSON.
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class CallStats:
+    def __init__(self):
+        self.series = {metric: TimeSeries() for metric in STATS_METRICS}
+        self.last_seen = 0.0
+
+    def add_sample(self, sample):
+        timestamp = sample.get('t')
+        if not is_finite_number(timestamp) or timestamp <= 0:
+            timestamp = time.time()
+        for metric, series in self.series.items():
+            value = sample.get(metric)
+            if is_finite_number(value):
+                series.append(float(timestamp), float(value))
+
+    def values(self, metric, tier=0):
+        return [value for _, value in self.series[metric].tiers[tier].items()]
+
+
+call_stats = OrderedDict()
+
+
+def expire_call_stats(now):
+    while call_stats:
+        call_id, stats = next(iter(call_stats.items()))
+        if now - stats.last_seen < STATS_IDLE_TIMEOUT and len(call_stats) <= STATS_MAX_CALLS:
+            break
+        del call_stats[call_id]
+
+
+def ingest_stats(data):
+    call_id = str(data.get('call', ''))[:64]
+    samples = data.get('samples')
+    if not call_id or not isinstance(samples, list):
+        raise ValueError('stats batch needs a call id and a list of samples')
+
+    now = time.time()
+    stats = call_stats.get(call_id)
+    if stats is None:
+        stats = call_stats[call_id] = CallStats()
+    call_stats.move_to_end(call_id)
+    stats.last_seen = now
+    for sample in samples:
+        if isinstance(sample, dict):
+            stats.add_sample(sample)
+    expire_call_stats(now)
+    return stats
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def summarize(values):
+    return {
+        'count': len(values),
+        'p50': percentile(values, 50),
+        'p90': percentile(values, 90),
+        'p99': percentile(values, 99),
+    }
+
+
+def bucket_key(value):
+    if value == 0:
+        return '0'
+    return f'{"+" if value > 0 else "-"}{round(math.log(abs(value), HISTOGRAM_GROWTH))}'
+
+
+def bucket_value(key):
+    if key == '0':
+        return 0.0
+    if key[:1] not in ('+', '-'):
+        raise ValueError(f'invalid histogram bucket: {key!r}')
+    return float(f'{key[0]}1') * HISTOGRAM_GROWTH ** int(key[1:])
+
+
+def histogram(values):
+    counts = {}
+    for value in values:
+        key = bucket_key(value)
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def merge_histograms(merged, other, count_key):
+    # Adds another node's histograms (as made by stats_histograms or
+    # trace_histograms) to `merged`. Checks everything before changing it.
+    count = other[count_key]
+    histograms = other['histograms']
+    if not isinstance(count, int) or not isinstance(histograms, dict):
+        raise ValueError('malformed histograms')
+    for counts in histograms.values():
+        for key, n in counts.items():
+            bucket_value(key)
+            if not isinstance(n, int) or n < 0:
+                raise ValueError('malformed histograms')
+
+    merged[count_key] += count
+    for name, counts in histograms.items():
+        target = merged['histograms'].setdefault(name, {})
+        for key, n in counts.items():
+            target[key] = target.get(key, 0) + n
+
+
+def summarize_histogram(counts):
+    buckets = sorted((bucket_value(key), n) for key, n in counts.items())
+    total = sum(n for _, n in buckets)
+
+    def at(pct):
+        if not total:
+            return None
+        rank = max(1, math.ceil(pct / 100 * total))
+        seen = 0
+        for value, n in buckets:
+            seen += n
+            if seen >= rank:
+                return value
+
+    return {'count': total, 'p50': at(50), 'p90': at(90), 'p99': at(99)}
+
+
+def stats_values(call_id=None, tier=0):
+    if call_id is None:
+        calls = list(call_stats.values())
+    elif call_id in call_stats:
+        calls = [call_stats[call_id]]
+    else:
+        return None
+
+    values = {}
+    for metric in STATS_METRICS:
+        values[metric] = []
+        for stats in calls:
+            values[metric].extend(stats.values(metric, tier))
+    return len(calls), values
+
+
+def stats_summary(call_id=None, tier=0):
+    found = stats_values(call_id, tier)
+    if found is None:
+        return None
+    calls, values = found
+    summary = {metric: summarize(values[metric]) for metric in STATS_METRICS}
+    return {'calls': calls, 'tier': tier, 'metrics': summary}
+
+
+def stats_histograms(tier=0):
+    calls, values = stats_values(None, tier)
+    return {'calls': calls, 'tier': tier,
+            'histograms': {metric: histogram(values[metric]) for metric in STATS_METRICS}}
+
+
+def stats_summary_from_histograms(histograms):
+    metrics = {metric: summarize_histogram(histograms['histograms'].get(metric, {}))
+               for metric in STATS_METRICS}
+    return {'calls': histograms['calls'], 'tier': histograms['tier'], 'metrics': metrics}
+
+
+####################
+# ADAPTIVE BITRATE #
+####################
+ABR_INTERVAL = 1.0
+ABR_MIN_BITRATE = 100_000
+ABR_MAX_BITRATE = 2_500_000
+# Only send a new recommendation when the target moves by more than this.
+ABR_MIN_CHANGE = 0.05
+# (minimum bitrate, scaleResolutionDownBy, maxFramerate), best first.
+ABR_LADDER = (
+    (1_200_000, 1.0, 30),
+    (600_000, 1.5, 30),
+    (300_000, 2.0, 24),
+    (0, 4.0, 15),
+)
+# Fields of a stats sample the estimators read.
+ABR_REPORT_FIELDS = ('send_loss', 'rtt', 'send_bitrate', 'available_bitrate')
+ABR_MAX_PEERS = 2 * STATS_MAX_CALLS
+ABR_ESTIMATOR_ENV = 'WEBRTC_ABR_ESTIMATOR'
+
+
+class AIMDEstimator:
+    def __init__(self, increase=50_000, decrease=0.85, loss_threshold=0.05):
+        self.increase = increase
+        self.decrease = decrease
+        self.loss_threshold = loss_threshold
+
+    def update(self, peer, report):
+        loss = report.get('send_loss', 0.0)
+        if loss > self.loss_threshold:
+            return peer.target * self.decrease
+        return peer.target + self.increase
+
+
+class GCCEstimator:
+    # Loss-based controller from draft-ietf-rmcat-gcc, combined with a crude
+    # delay-based one that backs off while the RTT keeps growing.
+    def __init__(self, rtt_gradient_threshold=10.0):
+        self.rtt_gradient_threshold = rtt_gradient_threshold
+
+    def update(self, peer, report):
+        loss = report.get('send_loss', 0.0)
+        rtt = report.get('rtt')
+        target = peer.target
+
+        if loss > 0.10:
+            target *= 1 - 0.5 * loss
+        elif loss < 0.02:
+            target *= 1.05
+
+        if rtt is not None and peer.last_rtt is not None:
+            if rtt - peer.last_rtt > self.rtt_gradient_threshold:
+                target = min(target, 0.85 * report.get('send_bitrate', target))
+        peer.last_rtt = rtt
+
+        available = report.get('available_bitrate')
+        if available:
+            target = min(target, available)
+        return target
+
+
+ESTIMATORS = {
+    'aimd': AIMDEstimator,
+    'gcc': GCCEstimator,
+}
+
+
+def merge_reports(merged, sample):
+    # Several samples arrive per batch: keep the worst loss so a spike early
+    # in the batch isn't masked by a clean last sample, the latest otherwise.
+    for key in ABR_REPORT_FIELDS:
+        value = sample.get(key)
+        if not is_finite_number(value):
+            continue
+        if key.endswith('loss') and key in merged:
+            merged[key] = max(merged[key], value)
+        else:
+            merged[key] = value
+
+
+class PeerRate:
+    # Calls start unconstrained: nothing is sent until the target drops below
+    # ABR_MAX_BITRATE, and the limit is lifted once it is back there.
+    def __init__(self):
+        self.target = ABR_MAX_BITRATE
+        self.sent_target = ABR_MAX_BITRATE
+        self.last_rtt = None
+        self.report = None
+        self.last_seen = 0.0
+        self.recommendation = None
+
+
+class BitrateController:
+    # Reports are only recorded on the request path; one timer thread
+    # re-evaluates every peer that reported since the last tick in a batch.
+    def __init__(self, estimator, interval=ABR_INTERVAL):
+        self.estimator = estimator
+        self.interval = interval
+        self.peers = OrderedDict()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def report(self, call_id, client_id, samples):
+        merged = {}
+        for sample in samples:
+            if isinstance(sample, dict):
+                merge_reports(merged, sample)
+        if not merged:
+            return
+        with self.lock:
+            key = (call_id, client_id)
+            peer = self.peers.get(key)
+            if peer is None:
+                peer = self.peers[key] = PeerRate()
+            self.peers.move_to_end(key)
+            while len(self.peers) > ABR_MAX_PEERS:
+                self.peers.popitem(last=False)
+            if peer.report is None:
+                peer.report = merged
+            else:
+                # Another batch since the last tick: fold it in.
+                merge_reports(peer.report, merged)
+            peer.last_seen = time.time()
+
+    def recommendation(self, call_id, client_id):
+        with self.lock:
+            peer = self.peers.get((call_id, client_id))
+            if peer is None:
+                return None
+            recommendation, peer.recommendation = peer.recommendation, None
+            return recommendation
+
+    def evaluate(self):
+        now = time.time()
+        with self.lock:
+            for key, peer in list(self.peers.items()):
+                if now - peer.last_seen > STATS_IDLE_TIMEOUT:
+                    del self.peers[key]
+                    continue
+                if peer.report is None:
+                    continue
+                report, peer.report = peer.report, None
+                target = self.estimator.update(peer, report)
+                peer.target = max(ABR_MIN_BITRATE, min(ABR_MAX_BITRATE, target))
+                if peer.target == ABR_MAX_BITRATE:
+                    if peer.sent_target < ABR_MAX_BITRATE:
+                        peer.sent_target = ABR_MAX_BITRATE
+                        peer.recommendation = encoder_settings(ABR_MAX_BITRATE)
+                elif abs(peer.target - peer.sent_target) > ABR_MIN_CHANGE * peer.sent_target:
+                    peer.sent_target = peer.target
+                    peer.recommendation = encoder_settings(peer.target)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.evaluate()
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='abr', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def encoder_settings(bitrate):
+    if bitrate >= ABR_MAX_BITRATE:
+        return {'bitrate': None, 'scale_resolution_down_by': 1.0, 'max_framerate': None}
+    for min_bitrate, scale, framerate in ABR_LADDER:
+        if bitrate >= min_bitrate:
+            break
+    return {
+        'bitrate': int(bitrate),
+        'scale_resolution_down_by': scale,
+        'max_framerate': framerate,
+    }
+
+
+def configure_estimator():
+    name = os.environ.get(ABR_ESTIMATOR_ENV, 'aimd')
+    if name not in ESTIMATORS:
+        raise ValueError(f'{ABR_ESTIMATOR_ENV} must be one of {", ".join(ESTIMATORS)}, not {name!r}')
+    return ESTIMATORS[name]()
+
+
+bitrate_controller = BitrateController(ESTIMATORS['aimd']())
+
+
+###########
+# TRACING #
+###########
+TRACE_PATH = '/meet/trace'
+TRACE_HEADER = 'X-Trace-Id'
+TRACE_MAX_TRACES = 1000
+TRACE_MAX_SPANS = 200
+TRACE_MAX_BODY = 64 * 1024
+TRACE_WATERFALL_WIDTH = 60
+TRACE_ID_RE = re.compile(r'[0-9a-f]{8,32}')
+
+# trace id -> spans, oldest trace evicted first.
+traces = OrderedDict()
+
+
+def new_trace_id():
+    return secrets.token_hex(8)
+
+
+def record_span(trace_id, source, name, start, end):
+    if not isinstance(trace_id, str) or not TRACE_ID_RE.fullmatch(trace_id):
+        return
+    spans = traces.get(trace_id)
+    if spans is None:
+        spans = traces[trace_id] = []
+        if len(traces) > TRACE_MAX_TRACES:
+            traces.popitem(last=False)
+    traces.move_to_end(trace_id)
+    if len(spans) < TRACE_MAX_SPANS:
+        spans.append({'source': source, 'name': name, 'start': start, 'end': end})
+
+
+def ingest_trace(data):
+    spans = data.get('spans')
+    if not isinstance(spans, list):
+        raise ValueError('trace batch needs a list of spans')
+    source = f'client {data.get("id")}'
+    for span in spans:
+        if not isinstance(span, dict):
+            continue
+        start, end = span.get('start'), span.get('end')
+        if not (is_finite_number(start) and is_finite_number(end)) or end < start:
+            continue
+        record_span(data.get('trace'), source, str(span.get('name'))[:64], start, end)
+
+
+def trace_waterfall(trace_id):
+    if trace_id not in traces:
+        return None
+    spans = sorted(traces[trace_id], key=lambda span: span['start'])
+    origin = spans[0]['start'] if spans else 0
+    return [
+        {
+            'source': span['source'],
+            'name': span['name'],
+            'offset_ms': round(span['start'] - origin, 3),
+            'duration_ms': round(span['end'] - span['start'], 3),
+        }
+        for span in spans
+    ]
+
+
+def format_waterfall(waterfall):
+    total = max((s['offset_ms'] + s['duration_ms'] for s in waterfall), default=0) or 1
+    scale = TRACE_WATERFALL_WIDTH / total
+    lines = []
+    for span in waterfall:
+        pad = int(span['offset_ms'] * scale)
+        bar = max(1, int(span['duration_ms'] * scale))
+        label = f'{span["source"]}: {span["name"]}'
+        lines.append(f'{label:<32} {" " * pad}{"#" * bar} '
+                     f'{span["offset_ms"]:.1f}+{span["duration_ms"]:.1f}ms')
+    return '\n'.join(lines) + '\n'
+
+
+def trace_durations():
+    durations = {}
+    for spans in traces.values():
+        for span in spans:
+            durations.setdefault(span['name'], []).append(span['end'] - span['start'])
+    return durations
+
+
+def trace_summary():
+    return {
+        'traces': len(traces),
+        'phases': {name: summarize(values) for name, values in sorted(trace_durations().items())},
+    }
+
 
-offers = {0: {}}
+def trace_histograms():
+    return {
+        'traces': len(traces),
+        'histograms': {name: histogram(values) for name, values in trace_durations().items()},
+    }
+
+
+def trace_summary_from_histograms(histograms):
+    return {
+        'traces': histograms['traces'],
+        'phases': {name: summarize_histogram(counts)
+                   for name, counts in sorted(histograms['histograms'].items())},
+    }
+
+
+RTC_CONFIGURATION = {'iceServers': [{'urls': 'stun:stun.l.google.com:19302'}]}
+
+
+###############
+# MATCHMAKING #
+###############
+# A visitor either joins the best waiting room it is compatible with or opens
+# a new one and waits in the pool. Waiting rooms sit in one heap per
+# (region, capability, codec), ordered by arrival time; a
+# visitor only looks at the heads of its own few heaps, so pairing is
+# O(k log n) for k codecs. Stale heap entries are dropped lazily.
+# The pages only know a caller and a callee, so this can't be changed yet.
+MATCH_GROUP_SIZE = 2
+# Rooms whose members stopped talking to us leave the pool after this long.
+MATCH_TIMEOUT = 60
+# After this long a waiting room also accepts visitors from other regions.
+MATCH_REGION_RELAX = 10
+MATCH_MAX_CODECS = 8
+ANY_REGION = '*'
+ANY_CODEC = '*'
+NO_CODEC_PREFERENCE = ''
+ROOM_IDLE_TIMEOUT = 600
+ROOM_MAX_ROOMS = 10000
+
+
+class Ticket:
+    __slots__ = ('room_id', 'region', 'capability', 'codecs', 'size', 'enqueued', 'members',
+                 'active')
+
+    def __init__(self, room_id, region, capability, codecs, size, enqueued, members=1):
+        self.room_id = room_id
+        self.region = region
+        self.capability = capability
+        self.codecs = codecs
+        self.size = size
+        self.enqueued = enqueued
+        self.members = members
+        self.active = True
+
+    def state(self):
+        return {
+            'region': self.region,
+            'capability': self.capability,
+            'codecs': list(self.codecs),
+            'size': self.size,
+            'enqueued': self.enqueued,
+            'members': self.members,
+        }
+
+
+class Matchmaker:
+    def __init__(self, alive, group_size=MATCH_GROUP_SIZE, relax_after=MATCH_REGION_RELAX):
+        if group_size != 2:
+            raise ValueError(f'group size {group_size} is not supported by the pages, only 2')
+        self.alive = alive
+        self.group_size = group_size
+        self.relax_after = relax_after
+        self.queues = {}
+        self.counter = itertools.count()
+        self.waiting = 0
+
+    def index_keys(self, region, capability, codecs):
+        # Tickets without codec preferences are compatible with everyone.
+        codec_keys = list(codecs) if codecs else [NO_CODEC_PREFERENCE]
+        codec_keys.append(ANY_CODEC)
+        for r in (region, ANY_REGION):
+            for codec in codec_keys:
+                yield (r, capability, codec)
+
+    def search_keys(self, region, capability, codecs):
+        codec_keys = list(codecs) + [NO_CODEC_PREFERENCE] if codecs else [ANY_CODEC]
+        for r in (region, ANY_REGION):
+            for codec in codec_keys:
+                yield (r, capability, codec)
+
+    def enqueue(self, room_id, region, capability, codecs, now, size=None, members=1):
+        ticket = Ticket(room_id, region, capability, tuple(codecs), size or self.group_size,
+                        now, members)
+        for key in self.index_keys(region, capability, ticket.codecs):
+            heapq.heappush(self.queues.setdefault(key, []),
+                           (ticket.enqueued, next(self.counter), ticket))
+        self.waiting += 1
+        return ticket
+
+    def head(self, key, now):
+        queue = self.queues.get(key)
+        while queue:
+            ticket = queue[0][2]
+            if ticket.active and self.alive(ticket, now):
+                return ticket
+            heapq.heappop(queue)
+            if ticket.active:
+                ticket.active = False
+                self.waiting -= 1
+        self.queues.pop(key, None)
+        return None
+
+    def match(self, region, capability, codecs, now):
+        best = None
+        for key in self.search_keys(region, capability, codecs):
+            ticket = self.head(key, now)
+            if ticket is None:
+                continue
+            if key[0] == ANY_REGION and ticket.region != region and now - ticket.enqueued < self.relax_after:
+                continue
+            if best is None or ticket.enqueued < best.enqueued:
+                best = ticket
+        if best is None:
+            return None
+
+        best.members += 1
+        if best.members >= best.size:
+            best.active = False
+            self.waiting -= 1
+        return best
+
+
+def parse_codecs(value):
+    codecs = {codec.strip().lower() for codec in value.split(',') if codec.strip()}
+    return sorted(codecs)[:MATCH_MAX_CODECS]
+
+
+# room id -> {0: room state, client id: client state}, least recently used first.
+rooms = OrderedDict()
+
+
+def room_alive(ticket, now):
+    room = rooms.get(ticket.room_id)
+    return room is not None and now - room[0]['last_seen'] < MATCH_TIMEOUT
+
+
+matchmaker = Matchmaker(room_alive)
+
+
+def touch_room(room_id, now):
+    rooms[room_id][0]['last_seen'] = now
+    rooms.move_to_end(room_id)
+
+
+def expire_rooms(now):
+    while rooms:
+        room_id, room = next(iter(rooms.items()))
+        # Leaves room for the one assign_room may add.
+        if now - room[0]['last_seen'] < ROOM_IDLE_TIMEOUT and len(rooms) < ROOM_MAX_ROOMS:
+            break
+        del rooms[room_id]
+
+
+def new_room_id():
+    # Random rather than sequential so ids don't collide across restarts or
+    # nodes; 48 bits keeps them exact as JavaScript numbers. In a cluster it
+    # takes about one try per node to land on an id this node owns.
+    while True:
+        room_id = secrets.randbits(48)
+        if room_id not in rooms and (cluster is None or cluster.owns(room_id)):
+            return room_id
+
+
+def assign_room(region, capability, codecs):
+    now = time.time()
+    expire_rooms(now)
+    ticket = matchmaker.match(region, capability, codecs, now)
+    if ticket is None:
+        room_id = new_room_id()
+        rooms[room_id] = {0: {'trace_id': new_trace_id(), 'last_seen': now}}
+        ticket = matchmaker.enqueue(room_id, region, capability, codecs, now)
+
+    room = rooms[ticket.room_id]
+    room[0]['match'] = ticket.state()
+    room[ticket.members] = {}
+    touch_room(ticket.room_id, now)
+    return ticket.room_id, ticket.members
+
+
+def restore_matchmaking():
+    # Put rooms from a snapshot that were still waiting back into the pool.
+    for room_id, room in rooms.items():
+        state = room[0].get('match')
+        if state and state['members'] < state['size']:
+            matchmaker.enqueue(room_id, state['region'], state['capability'], state['codecs'],
+                               state['enqueued'], state['size'], state['members'])
+
+
+BASE_TEMPLATE_PIECES = BASE_TEMPLATE.split('%s')
+CLIENT_2_JS_PIECES = CLIENT_2_JS.split('%s')
+
+
+def render_page(html, room_id, client_id, trace_id, js_parts):
+    # Returns the page as body parts (see COMPRESSION): the template is
+    # encoded once, only the per-visitor values for every page.
+    values = [
+        [static_part(html)],
+        [static_part(json.dumps(RTC_CONFIGURATION))],
+        [dynamic_part(json.dumps(room_id))],
+        [dynamic_part(json.dumps(client_id))],
+        [dynamic_part(json.dumps(trace_id))],
+        js_parts,
+    ]
+    parts = [static_part(BASE_TEMPLATE_PIECES[0])]
+    for value, piece in zip(values, BASE_TEMPLATE_PIECES[1:]):
+        parts.extend(value)
+        parts.append(static_part(piece))
+    return parts
+
+
+def render_template(room_id, client_id):
+    room = rooms[room_id]
+    trace_id = room[0]['trace_id']
+    if client_id == 1:
+        js_parts = [static_part(CLIENT_1_JS)]
+        return render_page(CLIENT_1_HTML, room_id, client_id, trace_id, js_parts), trace_id
+    # Without an offer yet the page polls for it.
+    offer = room[1].get('offer')
+    js_parts = [
+        static_part(CLIENT_2_JS_PIECES[0]),
+        offer_part((room_id, 1), offer) if offer is not None else dynamic_part('null'),
+        static_part(CLIENT_2_JS_PIECES[1]),
+    ]
+    return render_page(CLIENT_2_HTML, room_id, client_id, trace_id, js_parts), trace_id
+
+
+#####################
+# BATCHED SIGNALING #
+#####################
+# Everything a client posts is appended to its event log under a per-call
+# sequence number. A batch request applies the client's operations and
+# returns the peers' events after the client's cursor, so offer, candidates
+# and polling for the answer share one round trip.
+BATCH_PATH = '/meet/batch'
+BATCH_MAX_BODY = 256 * 1024
+BATCH_MAX_OPS = 16
+BATCH_MAX_CANDIDATES = 64
+# Events a client may have waiting for its peers to acknowledge.
+BATCH_MAX_EVENTS = 64
+# Offers are RTCSessionDescription.toJSON(): {type, sdp}.
+OFFER_KEYS = {'type', 'sdp'}
+OFFER_MAX_SDP = 64 * 1024
+
+
+# Provisional descriptions from pre-warmed clients, published on commit.
+WARM_MAX_SLOTS = 10000
+WARM_MAX_BYTES = 64 * 1024 * 1024
+WARM_TTL = 120
+
+
+class WarmPool:
+    def __init__(self, max_slots=WARM_MAX_SLOTS, max_bytes=WARM_MAX_BYTES, ttl=WARM_TTL):
+        self.max_slots = max_slots
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # Every slot lives for the same ttl, so insertion order is expiry order.
+        self.slots = OrderedDict()
+        self.bytes = 0
+
+    def pop(self, key=None):
+        if key is None:
+            _, (_, offer) = self.slots.popitem(last=False)
+        else:
+            _, offer = self.slots.pop(key)
+        self.bytes -= len(offer['sdp'])
+        return offer
+
+    def expire(self, now):
+        while self.slots and next(iter(self.slots.values()))[0] <= now:
+            self.pop()
+
+    def put(self, key, offer):
+        now = time.time()
+        if key in self.slots:
+            self.pop(key)
+        self.slots[key] = (now + self.ttl, offer)
+        self.bytes += len(offer['sdp'])
+        self.expire(now)
+        while len(self.slots) > self.max_slots or self.bytes > self.max_bytes:
+            self.pop()
+
+    def take(self, key):
+        self.expire(time.time())
+        return self.pop(key) if key in self.slots else None
+
+
+warm_pool = WarmPool()
+
+
+def append_event(room, client_id, kind, data):
+    state = room[0]
+    state['seq'] = state.get('seq', 0) + 1
+    room[client_id].setdefault('events', []).append([state['seq'], kind, data])
+
+
+def post_offer(room, client_id, offer):
+    room[client_id]['offer'] = offer
+    append_event(room, client_id, 'offer', offer)
+
+
+def peer_ids(room, client_id):
+    return [peer_id for peer_id in room if peer_id not in (0, client_id)]
+
+
+def trim_events(room):
+    # Drop events every other client has acknowledged.
+    for client_id, client in room.items():
+        events = client.get('events')
+        if not events:
+            continue
+        acked = min((room[peer_id].get('acked', 0) for peer_id in peer_ids(room, client_id)), default=0)
+        while events and events[0][0] <= acked:
+            events.pop(0)
+
+
+def peer_updates(room, client_id, cursor):
+    updates = []
+    for peer_id in peer_ids(room, client_id):
+        for seq, kind, data in room[peer_id].get('events', ()):
+            if seq > cursor:
+                updates.append({'seq': seq, 'from': peer_id, 'type': kind, 'data': data})
+    updates.sort(key=lambda update: update['seq'])
+    return updates
+
+
+def validate_op(op):
+    if not isinstance(op, dict):
+        raise ValueError('operation must be an object')
+    kind = op.get('op')
+    if kind in ('offer', 'warm'):
+        offer = op.get('offer')
+        if (not isinstance(offer, dict) or set(offer) != OFFER_KEYS
+                or not isinstance(offer['type'], str) or not isinstance(offer['sdp'], str)):
+            raise ValueError('offer operation needs an offer with a type and an sdp')
+        if len(offer['sdp']) > OFFER_MAX_SDP:
+            raise ValueError('offer sdp is too large')
+    elif kind == 'candidates':
+        candidates = op.get('candidates')
+        if not isinstance(candidates, list) or len(candidates) > BATCH_MAX_CANDIDATES:
+            raise ValueError('candidates operation needs a list of candidates')
+    elif kind == 'ack':
+        cursor = op.get('cursor')
+        if not isinstance(cursor, int) or isinstance(cursor, bool):
+            raise ValueError('ack operation needs an integer cursor')
+    elif kind not in ('fetch', 'commit'):
+        raise ValueError(f'unknown operation: {kind!r}')
+
+
+def find_client(data):
+    room_id = data.get('room')
+    client_id = data.get('id')
+    room = rooms.get(room_id) if isinstance(room_id, int) else None
+    if room is None:
+        raise ValueError(f'unknown room: {room_id!r}')
+    if not isinstance(client_id, int) or client_id == 0 or client_id not in room:
+        raise ValueError(f'unknown client: {client_id!r}')
+    return room_id, room, client_id
+
+
+def apply_batch(data):
+    room_id, room, client_id = find_client(data)
+    ops = data.get('ops')
+    if not isinstance(ops, list) or len(ops) > BATCH_MAX_OPS:
+        raise ValueError('batch needs a list of operations')
+    # Validate everything first so a batch is applied completely or not at all.
+    for op in ops:
+        validate_op(op)
+    client = room[client_id]
+    # A client alone in its room has nobody to acknowledge its events.
+    added = sum(1 for op in ops if op['op'] in ('offer', 'commit', 'candidates'))
+    if len(client.get('events', ())) + added > BATCH_MAX_EVENTS:
+        raise ValueError('too many unacknowledged events')
+
+    response = {}
+    fetch_from = None
+    for op in ops:
+        kind = op['op']
+        if kind == 'offer':
+            post_offer(room, client_id, op['offer'])
+        elif kind == 'warm':
+            warm_pool.put((room_id, client_id), op['offer'])
+        elif kind == 'commit':
+            offer = warm_pool.take((room_id, client_id))
+            if offer is not None:
+                post_offer(room, client_id, offer)
+            response['committed'] = offer is not None
+        elif kind == 'candidates':
+            if op['candidates']:
+                append_event(room, client_id, 'candidates', op['candidates'])
+        elif kind == 'ack':
+            client['acked'] = max(client.get('acked', 0), op['cursor'])
+        elif kind == 'fetch':
+            fetch_from = client.get('acked', 0)
+    trim_events(room)
+    touch_room(room_id, time.time())
+
+    response['cursor'] = room[0].get('seq', 0)
+    response['updates'] = []
+    if fetch_from is not None:
+        response['updates'] = peer_updates(room, client_id, fetch_from)
+    return response
+
+
+###############
+# COMPRESSION #
+###############
+# Request bodies may be gzip/deflate encoded and are inflated with a cap on
+# the decoded size. Responses are compressed when the client accepts it.
+#
+# Pages and batch replies are built from parts: (bytes, deflate blocks)
+# pairs. The blocks end on a byte boundary and never refer back past their
+# own start, so the blocks of consecutive parts concatenate into one valid
+# deflate stream. Template text and offers are compressed once and cached;
+# only the small per-request parts are compressed per response.
+COMPRESS_MIN_SIZE = 512
+# Parts shorter than this go out as stored blocks rather than compressed.
+COMPRESS_STORED_MAX = 128
+COMPRESS_LEVEL = 6
+COMPRESS_CACHE_SIZE = 4096
+MAX_DECODED_BODY = 1024 * 1024
+# Non-browser clients (and other signaling servers) can opt into deflate
+# primed with SDP_DICTIONARY, which is served at SDP_DICTIONARY_PATH.
+SDP_DICTIONARY_ENCODING = 'x-sdp-deflate'
+SDP_DICTIONARY_PATH = '/meet/sdp-dictionary'
+# Boilerplate that appears in nearly every browser offer and answer, written
+# the way it shows up inside a JSON string. zlib finds matches near the end
+# of the dictionary most cheaply, so the most frequent lines come last.
+SDP_DICTIONARY = '\\r\\n'.join([
+    'a=candidate:1 1 udp 2122260223 192.168.1.2 54321 typ host generation 0 network-id 1',
+    'a=candidate:2 1 udp 1686052607 203.0.113.2 54321 typ srflx raddr 192.168.1.2 rport 54321',
+    'a=candidate:3 1 tcp 1518280447 192.168.1.2 9 typ host tcptype active generation 0 network-id 1',
+    'a=candidate:4 1 udp 41885439 198.51.100.2 3478 typ relay raddr 203.0.113.2 rport 54321',
+    'a=rtpmap:35 AV1/90000',
+    'a=rtpmap:45 AV1/90000',
+    'a=fmtp:45 level-idx=5;profile=0;tier=0',
+    'a=rtpmap:98 VP9/90000',
+    'a=fmtp:98 profile-id=0',
+    'a=rtpmap:100 VP9/90000',
+    'a=fmtp:100 profile-id=2',
+    'a=rtpmap:102 H264/90000',
+    'a=fmtp:102 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42001f',
+    'a=rtpmap:127 H264/90000',
+    'a=fmtp:127 level-asymmetry-allowed=1;packetization-mode=0;profile-level-id=42001f',
+    'a=rtpmap:112 H264/90000',
+    'a=fmtp:112 level-asymmetry-allowed=1;packetization-mode=1;profile-level-id=42e01f',
+    'a=rtpmap:116 red/90000',
+    'a=rtpmap:118 ulpfec/90000',
+    'a=rtpmap:63 red/48000/2',
+    'a=fmtp:63 111/111',
+    'a=rtpmap:9 G722/8000',
+    'a=rtpmap:0 PCMU/8000',
+    'a=rtpmap:8 PCMA/8000',
+    'a=rtpmap:13 CN/8000',
+    'a=rtpmap:110 telephone-event/48000',
+    'a=rtpmap:126 telephone-event/8000',
+    'a=extmap:1 urn:ietf:params:rtp-hdrext:ssrc-audio-level',
+    'a=extmap:2 http://www.webrtc.org/experiments/rtp-hdrext/abs-send-time',
+    'a=extmap:3 http://www.ietf.org/id/draft-holmer-rmcat-transport-wide-cc-extensions-01',
+    'a=extmap:4 urn:ietf:params:rtp-hdrext:sdes:mid',
+    'a=extmap:9 urn:ietf:params:rtp-hdrext:sdes:rtp-stream-id',
+    'a=extmap:10 urn:ietf:params:rtp-hdrext:sdes:repaired-rtp-stream-id',
+    'a=extmap:11 urn:ietf:params:rtp-hdrext:toffset',
+    'a=extmap:12 urn:3gpp:video-orientation',
+    'a=extmap:13 http://www.webrtc.org/experiments/rtp-hdrext/playout-delay',
+    'a=extmap:14 http://www.webrtc.org/experiments/rtp-hdrext/video-content-type',
+    'a=extmap:15 http://www.webrtc.org/experiments/rtp-hdrext/video-timing',
+    'a=extmap:16 http://www.webrtc.org/experiments/rtp-hdrext/color-space',
+    'm=application 9 UDP/DTLS/SCTP webrtc-datachannel',
+    'a=sctp-port:5000',
+    'a=max-message-size:262144',
+    'm=audio 9 UDP/TLS/RTP/SAVPF 111 63 9 0 8 13 110 126',
+    'a=rtpmap:111 opus/48000/2',
+    'a=rtcp-fb:111 transport-cc',
+    'a=fmtp:111 minptime=10;useinbandfec=1',
+    'v=0',
+    'o=- 4611731400430051336 2 IN IP4 127.0.0.1',
+    's=-',
+    't=0 0',
+    'a=group:BUNDLE 0 1',
+    'a=extmap-allow-mixed',
+    'a=msid-semantic: WMS',
+    'm=video 9 UDP/TLS/RTP/SAVPF 96 97 98 99 100 101 102 103 104 105 106 107 108 109 127 125 39 40 45 46 112 113 116 117 118',
+    'c=IN IP4 0.0.0.0',
+    'a=rtcp:9 IN IP4 0.0.0.0',
+    'a=ice-ufrag:',
+    'a=ice-pwd:',
+    'a=ice-options:trickle',
+    'a=fingerprint:sha-256 ',
+    'a=setup:actpass',
+    'a=mid:0',
+    'a=sendrecv',
+    'a=msid:',
+    'a=rtcp-mux',
+    'a=rtcp-rsize',
+    'a=rtpmap:96 VP8/90000',
+    'a=rtcp-fb:96 goog-remb',
+    'a=rtcp-fb:96 transport-cc',
+    'a=rtcp-fb:96 ccm fir',
+    'a=rtcp-fb:96 nack',
+    'a=rtcp-fb:96 nack pli',
+    'a=rtpmap:97 rtx/90000',
+    'a=fmtp:97 apt=96',
+    'a=ssrc-group:FID ',
+    'a=ssrc:',
+    ' cname:',
+    ' msid:',
+    '{"candidate": "candidate:',
+    '", "sdpMid": "0", "sdpMLineIndex": 0, "usernameFragment": "',
+    '{"type": "answer", "sdp": "v=0',
+    '{"type": "offer", "sdp": "v=0',
+]).encode('utf8')
+# Preferred first when the client weighs several codings equally.
+RESPONSE_ENCODINGS = (SDP_DICTIONARY_ENCODING, 'gzip', 'deflate')
+
+
+def decode_body(body, content_encoding, limit):
+    # Inflates at most `limit` bytes so a small compressed body can't expand
+    # into an unbounded amount of memory.
+    content_encoding = (content_encoding or 'identity').strip().lower()
+    if content_encoding == 'identity':
+        if len(body) > limit:
+            raise ValueError('decoded body too large')
+        return body
+    if content_encoding in ('gzip', 'x-gzip'):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif content_encoding == 'deflate':
+        decompressor = zlib.decompressobj()
+    elif content_encoding == 'deflate-raw':
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    elif content_encoding == SDP_DICTIONARY_ENCODING:
+        decompressor = zlib.decompressobj(zdict=SDP_DICTIONARY)
+    else:
+        raise ValueError(f'unsupported content encoding: {content_encoding}')
+    try:
+        decoded = decompressor.decompress(body, limit)
+    except zlib.error as e:
+        raise ValueError(f'invalid {content_encoding} body: {e}')
+    if decompressor.unconsumed_tail:
+        raise ValueError('decoded body too large')
+    if not decompressor.eof:
+        raise ValueError(f'truncated {content_encoding} body')
+    return decoded
+
+
+def encode_body(body, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        compressor = zlib.compressobj(COMPRESS_LEVEL)
+    elif encoding == SDP_DICTIONARY_ENCODING:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zdict=SDP_DICTIONARY)
+    else:
+        return body
+    return compressor.compress(body) + compressor.flush()
+
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+ZLIB_HEADER = b'\x78\x9c'
+# Final, empty, fixed-Huffman block.
+DEFLATE_END = b'\x03\x00'
+
+
+def deflate_blocks(data):
+    if len(data) < COMPRESS_STORED_MAX:
+        if not data:
+            return b''
+        return b'\x00' + struct.pack('<HH', len(data), len(data) ^ 0xffff) + data
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+static_parts = {}
+
+
+def static_part(text):
+    part = static_parts.get(text)
+    if part is None:
+        data = text.encode('utf8')
+        part = static_parts[text] = (data, deflate_blocks(data))
+    return part
+
+
+def dynamic_part(text):
+    return (text.encode('utf8'), None)
+
+
+def offer_part(key, offer):
+    part = offer_cache.get(key, offer, 'part')
+    if part is None:
+        data = json.dumps(offer).encode('utf8')
+        part = (data, deflate_blocks(data))
+        offer_cache.put(key, offer, 'part', part)
+    return part
+
+
+def join_parts(parts, encoding):
+    data = b''.join(data for data, _ in parts)
+    if encoding not in ('gzip', 'deflate'):
+        # Dictionary streams can't be spliced: later blocks would see the
+        # previous parts where their encoder saw the dictionary.
+        return encode_body(data, encoding)
+    blocks = [blocks if blocks is not None else deflate_blocks(data) for data, blocks in parts]
+    body = b''.join(blocks) + DEFLATE_END
+    if encoding == 'gzip':
+        return GZIP_HEADER + body + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff)
+    return ZLIB_HEADER + body + struct.pack('>I', zlib.adler32(data))
+
+
+def batch_parts(room_id, response):
+    # Offers among the updates are spliced in from their cached encoding.
+    head = json.dumps({key: value for key, value in response.items() if key != 'updates'})
+    text = [head[:-1], ', "updates": [']
+    parts = []
+    for i, update in enumerate(response['updates']):
+        if i:
+            text.append(', ')
+        if update['type'] != 'offer':
+            text.append(json.dumps(update))
+            continue
+        meta = json.dumps({key: value for key, value in update.items() if key != 'data'})
+        text.append(meta[:-1] + ', "data": ')
+        parts.append(dynamic_part(''.join(text)))
+        parts.append(offer_part((room_id, update['from']), update['data']))
+        text = ['}']
+    text.append(']}')
+    parts.append(dynamic_part(''.join(text)))
+    return parts
+
+
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        coding = coding.strip().lower()
+        weight = 1.0
+        match = re.search(r'q=([0-9.]+)', params)
+        if match:
+            try:
+                weight = float(match.group(1))
+            except ValueError:
+                weight = 0.0
+        if coding == 'x-gzip':
+            coding = 'gzip'
+        weights[coding] = weight
+    best, best_weight = None, 0.0
+    for coding in RESPONSE_ENCODINGS:
+        # '*' covers everything standard; the dictionary coding has to be
+        # asked for by name.
+        default = weights.get('*', 0.0) if coding != SDP_DICTIONARY_ENCODING else 0.0
+        weight = weights.get(coding, default)
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+class CompressedCache:
+    # LRU of encoded responses. An entry is only valid while its source is
+    # still the very same object, so replacing an offer invalidates it.
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def get(self, key, source, encoding):
+        entry = self.entries.get((key, encoding))
+        if entry is None or entry[0] is not source:
+            return None
+        self.entries.move_to_end((key, encoding))
+        return entry[1]
+
+    def put(self, key, source, encoding, data):
+        self.entries[key, encoding] = (source, data)
+        self.entries.move_to_end((key, encoding))
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+offer_cache = CompressedCache(COMPRESS_CACHE_SIZE)
+
+
+#########
+# ADMIN #
+#########
+# Live diagnostics under ADMIN_PATH, enabled by setting ADMIN_TOKEN_ENV and
+# sending it as `Authorization: Bearer <token>`:
+#
+#   POST profile/start?interval=0.01&duration=60   start sampling all threads
+#   POST profile/stop                              stop, return collapsed stacks
+#   GET  profile                                   collapsed stacks so far
+#   POST tracemalloc/start?frames=10               start tracing, take a baseline
+#   GET  tracemalloc?key=lineno&limit=30           top allocations and diff
+#   POST tracemalloc/stop
+#   GET  memory                                    deep size of the session store
+#
+# Collapsed stacks ("thread;outer;...;inner count") feed straight into
+# flamegraph.pl or speedscope.
+ADMIN_PATH = '/meet/admin'
+ADMIN_TOKEN_ENV = 'WEBRTC_ADMIN_TOKEN'
+PROFILE_DEFAULT_INTERVAL = 0.01
+PROFILE_MIN_INTERVAL = 0.001
+PROFILE_MAX_DURATION = 600
+# Connection threads are short-lived; their samples share one root.
+PROFILE_REQUEST_THREAD_LABEL = 'request-handlers'
+TRACEMALLOC_DEFAULT_FRAMES = 10
+TRACEMALLOC_DEFAULT_LIMIT = 30
+
+
+class SamplingProfiler:
+    # Samples the stacks of all other threads from a background thread, so
+    # the request path runs unmodified. Stacks are kept as tuples of code
+    # objects and only turned into names when they are reported.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+        self.samples = {}
+        self.interval = PROFILE_DEFAULT_INTERVAL
+        self.started = None
+        self.stopped = None
+        self.sample_count = 0
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval, duration):
+        if self.running():
+            raise ValueError('profiler already running')
+        self.stopping.clear()
+        with self.lock:
+            self.samples = {}
+            self.interval = interval
+            self.started = time.time()
+            self.stopped = None
+            self.sample_count = 0
+        self.thread = threading.Thread(
+            target=self.run, args=(interval, time.monotonic() + duration),
+            name='profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self, interval, deadline):
+        own_ident = threading.get_ident()
+        request_code = ThreadingMixIn.process_request_thread.__code__
+        while not self.stopping.wait(interval) and time.monotonic() < deadline:
+            frames = sys._current_frames()
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident == own_ident:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(frame.f_code)
+                        frame = frame.f_back
+                    if request_code in stack:
+                        thread = PROFILE_REQUEST_THREAD_LABEL
+                    else:
+                        thread = thread_names.get(ident, f'thread-{ident}')
+                    key = (thread, tuple(stack))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+                self.sample_count += 1
+            del frames
+        self.stopped = time.time()
+
+    def status(self):
+        return {
+            'running': self.running(),
+            'interval': self.interval,
+            'started': self.started,
+            'stopped': self.stopped,
+            'samples': self.sample_count,
+        }
+
+    def collapsed(self):
+        labels = {}
+        folded = {}
+        with self.lock:
+            samples = list(self.samples.items())
+        for (thread, stack), count in samples:
+            names = [thread]
+            for code in reversed(stack):
+                label = labels.get(code)
+                if label is None:
+                    filename = os.path.basename(code.co_filename).replace(';', ':')
+                    label = labels[code] = f'{code.co_name} ({filename}:{code.co_firstlineno})'
+                names.append(label)
+            line = ';'.join(names)
+            folded[line] = folded.get(line, 0) + count
+        return ''.join(f'{line} {count}\n' for line, count in sorted(folded.items()))
+
+
+def tracemalloc_start(frames):
+    global tracemalloc_baseline
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    tracemalloc_baseline = take_tracemalloc_snapshot()
+
+
+def take_tracemalloc_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+
+
+def tracemalloc_report(key_type, limit):
+    snapshot = take_tracemalloc_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    report = {
+        'traced': current,
+        'peak': peak,
+        'overhead': tracemalloc.get_tracemalloc_memory(),
+        'top': [{
+            'size': stat.size,
+            'count': stat.count,
+            'trace': stat.traceback.format(),
+        } for stat in snapshot.statistics(key_type)[:limit]],
+    }
+    if tracemalloc_baseline is not None:
+        report['diff'] = [{
+            'size': stat.size,
+            'size_diff': stat.size_diff,
+            'count': stat.count,
+            'count_diff': stat.count_diff,
+            'trace': stat.traceback.format(),
+        } for stat in snapshot.compare_to(tracemalloc_baseline, key_type)[:limit]]
+    return report
+
+
+def tracemalloc_stop():
+    global tracemalloc_baseline
+    tracemalloc_baseline = None
+    tracemalloc.stop()
+
+
+def deep_size(root):
+    # Follows containers and instances of this module's classes only, so a
+    # reference to a function, lock or thread doesn't pull in the world.
+    seen = set()
+    size = 0
+    objects = 0
+    pending = [root]
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        objects += 1
+        if isinstance(obj, dict):
+            pending.extend(obj.keys())
+            pending.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            pending.extend(obj)
+        elif type(obj).__module__ == __name__:
+            if hasattr(obj, '__dict__'):
+                pending.append(obj.__dict__)
+            for name in getattr(type(obj), '__slots__', ()):
+                if hasattr(obj, name):
+                    pending.append(getattr(obj, name))
+    return size, objects
+
+
+def memory_report():
+    structures = {
+        'rooms': rooms,
+        'matchmaker': matchmaker,
+        'warm_pool': warm_pool,
+        'offer_cache': offer_cache,
+        'call_stats': call_stats,
+        'traces': traces,
+        'bitrate_controller': bitrate_controller,
+        'templates': [BASE_TEMPLATE, CLIENT_1_JS, CLIENT_2_JS, SDP_DICTIONARY],
+    }
+    report = {}
+    for name, structure in structures.items():
+        started = time.perf_counter()
+        size, objects = deep_size(structure)
+        report[name] = {
+            'bytes': size,
+            'objects': objects,
+            'walk_ms': round((time.perf_counter() - started) * 1000, 3),
+        }
+    return {
+        'structures': report,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'gc_objects': len(gc.get_objects()),
+    }
+
+
+profiler = SamplingProfiler()
+tracemalloc_baseline = None
+
+
+###########
+# CLUSTER #
+###########
+# With CLUSTER_NODES_ENV set to the same comma separated host:port list on
+# every node, each room lives on exactly one node: the owner of its id on a
+# consistent-hash ring. Nodes only create rooms with ids they own, so any
+# node can route a request from its room id alone. Requests for rooms owned
+# elsewhere are forwarded there.
+#
+# If clients can reach the nodes directly, CLUSTER_REDIRECT_ENV turns page
+# loads and requests from non-browser clients into 307 redirects. Browser
+# fetch() calls are still forwarded: a cross-origin redirect would need CORS,
+# which the signaling routes don't speak. They are rare anyway, since a
+# redirected page is served by the node owning its room.
+#
+# The fleet-wide /meet/stats and /meet/trace summaries ask every other node
+# for its values as histograms (format=histogram) and compute the
+# percentiles from their sum, so they have the same shape as on a single
+# node. Nodes that don't answer are listed under missing_nodes.
+#
+# Matchmaking pools are placed on the same ring: a visitor's page request
+# goes to the owner of its (region, capability) pool, so everyone who could
+# be paired is matched in one process, and the rooms that process opens are
+# its own. Relaxed cross-region matching only reaches pools on that node.
+#
+#   WEBRTC_CLUSTER_NODES=127.0.0.1:8001,127.0.0.1:8002 WEBRTC_PORT=8001 \
+#       WEBRTC_CLUSTER_SELF=127.0.0.1:8001 ./webrtc_server.py
+CLUSTER_NODES_ENV = 'WEBRTC_CLUSTER_NODES'
+CLUSTER_SELF_ENV = 'WEBRTC_CLUSTER_SELF'
+CLUSTER_REDIRECT_ENV = 'WEBRTC_CLUSTER_REDIRECT'
+# Points per node; more spreads the id space more evenly across nodes.
+CLUSTER_VNODES = 160
+CLUSTER_TIMEOUT = 5
+# Set on forwarded requests; the receiver always handles them itself, so two
+# nodes with different node lists can't bounce a request between them. Only
+# honoured from the nodes' own addresses.
+CLUSTER_HOP_HEADER = 'X-Cluster-Hop'
+CLUSTER_REQUEST_HEADERS = ('Content-Type', 'Content-Encoding', 'Accept-Encoding',
+                           TRACE_HEADER, 'X-Region', 'User-Agent')
+CLUSTER_RESPONSE_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary')
+
+
+def ring_hash(key):
+    digest = hashlib.blake2b(str(key).encode('utf8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big')
+
+
+class HashRing:
+    # Adding or removing a node only moves the ids that hash between its
+    # points and their predecessors: about 1/n of the id space.
+    def __init__(self, nodes, vnodes=CLUSTER_VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.owners = [node for _, node in points]
+
+    def owner(self, key):
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        return self.owners[index % len(self.owners)]
+
+
+class Cluster:
+    def __init__(self, nodes, self_node, redirect=False):
+        if self_node not in nodes:
+            raise ValueError(f'{self_node} is not in the cluster node list {nodes}')
+        self.ring = HashRing(nodes)
+        self.self_node = self_node
+        self.redirect = redirect
+        # Requests claiming to come from another node must come from one of
+        # these addresses.
+        self.addresses = set()
+        for node in nodes:
+            host = node.rpartition(':')[0].strip('[]')
+            try:
+                self.addresses.update(info[4][0] for info in socket.getaddrinfo(host, None))
+            except OSError:
+                self.addresses.add(host)
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.self_node
+
+    def forward(self, node, method, path, headers, body):
+        host, _, port = node.rpartition(':')
+        connection = http.client.HTTPConnection(host, int(port), timeout=CLUSTER_TIMEOUT)
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            return response.status, response.getheaders(), response.read()
+        finally:
+            connection.close()
+
+
+def configure_cluster(port):
+    nodes = [node.strip() for node in os.environ.get(CLUSTER_NODES_ENV, '').split(',') if node.strip()]
+    if not nodes:
+        return None
+    self_node = os.environ.get(CLUSTER_SELF_ENV) or f'127.0.0.1:{port}'
+    return Cluster(nodes, self_node, redirect=bool(os.environ.get(CLUSTER_REDIRECT_ENV)))
+
+
+def pool_key(region, capability):
+    return f'pool:{region}:{capability}'
+
+
+def as_room_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
 
-def render_template():
-    client_id = 0
-    if 1 not in offers:
-        offers[1] = {}
-        return CLIENT_1
-    elif 2 not in offers:
-        offers[2] = {}
-        client_2_js = CLIENT_2_JS % json.dumps(offers[1]['offer'])
-        return BASE_TEMPLATE % (CLIENT_2_HTML, client_2_js)
-    return ''
+def room_of(data, key='room'):
+    # Room id from a request body, as the clients send it.
+    return as_room_id(data.get(key)) if isinstance(data, dict) else None
+
+
+cluster = None
+# Handlers run one at a time under this lock, as on a single-threaded
+# server. A handler only lets go of it while waiting for another node.
+state_lock = threading.Lock()
 
 
 MEETING_PATH = '/meet'
+REQUEST_TIMEOUT = 10
+MAX_REQUEST_BODY = max(STATS_MAX_BODY, TRACE_MAX_BODY, BATCH_MAX_BODY)
 
 
 class Handler(BaseHTTPRequestHandler):
+    # Socket timeout for reading a request; bounds how long a stalled client
+    # can keep its thread, and the shutdown join, waiting.
+    timeout = REQUEST_TIMEOUT
+
     def version_string(self):
         return 'Apache'
 
@@ -472,70 +2338,485 @@ class Handler(BaseHTTPRequestHandler):
         if with_headers:
             self.log_message('  headers:')
             for header, value in self.headers.items():
+                if header.lower() == 'authorization':
+                    value = '<redacted>'
                 self.log_message('    %s: %s', header, value)
 
+    def setup(self):
+        super().setup()
+        with self.server.waiting_lock:
+            self.server.waiting.add(self.connection)
+
+    def finish(self):
+        with self.server.waiting_lock:
+            self.server.waiting.discard(self.connection)
+        super().finish()
+
+    def parse_request(self):
+        self.request_started = time.time()
+        with self.server.waiting_lock:
+            self.server.waiting.discard(self.connection)
+        return super().parse_request()
+
+    def handle_one_request(self):
+        # Every /meet request carrying a trace id becomes a server span.
+        self.request_started = None
+        self.trace_id = None
+        self.raw_body = b''
+        self.forwarded = False
+        super().handle_one_request()
+        if self.request_started is None or not self.command or self.forwarded:
+            return
+        path = urlsplit(self.path).path
+        if path.startswith((STATS_PATH, TRACE_PATH)):
+            return
+        trace_id = self.trace_id or self.headers.get(TRACE_HEADER)
+        if trace_id:
+            with state_lock:
+                record_span(trace_id, 'server', f'{self.command} {path}',
+                            self.request_started * 1000, time.time() * 1000)
+
     def not_found(self):
         self.log_request(not_found=True)
         self.send_response_only(HTTPStatus.NOT_FOUND)
         self.end_headers()
 
-    def do_GET(self):
-        if not self.path.startswith(MEETING_PATH):
+    def bad_request(self, reason):
+        self.log_message('"%s" => 400 Bad Request: %s', self.requestline, reason)
+        self.send_response_only(HTTPStatus.BAD_REQUEST)
+        self.send_header('Content-Length', 0)
+        self.end_headers()
+
+    def send_json(self, data, status=HTTPStatus.OK):
+        self.send_content(json.dumps(data), 'application/json', status)
+
+    def send_content(self, content, content_type, status=HTTPStatus.OK):
+        encoded_content = content.encode('utf8')
+        encoding = None
+        if len(encoded_content) >= COMPRESS_MIN_SIZE:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+            encoded_content = encode_body(encoded_content, encoding)
+        self.send_encoded(encoded_content, content_type, encoding, status)
+
+    def send_encoded(self, encoded_content, content_type, encoding, status=HTTPStatus.OK):
+        self.send_response_only(status)
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+        self.send_header('Content-Type', content_type)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Content-Length', len(encoded_content))
+        self.end_headers()
+        self.wfile.write(encoded_content)
+
+    def send_parts(self, parts, content_type, status=HTTPStatus.OK):
+        encoding = None
+        if sum(len(data) for data, _ in parts) >= COMPRESS_MIN_SIZE:
+            encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        self.send_encoded(join_parts(parts, encoding), content_type, encoding, status)
+
+    def send_offer(self, room_id, client_id, offer):
+        encoding = choose_encoding(self.headers.get('Accept-Encoding'))
+        encoded_content = offer_cache.get((room_id, client_id), offer, encoding)
+        if encoded_content is None:
+            encoded_content = join_parts([offer_part((room_id, client_id), offer)], encoding)
+            offer_cache.put((room_id, client_id), offer, encoding, encoded_content)
+        self.send_encoded(encoded_content, 'application/json', encoding)
+
+    def receive_body(self):
+        # Runs before state_lock is taken, so a slow upload only holds up
+        # its own connection. read_body applies each route's own limit.
+        content_length = self.headers.get('Content-Length')
+        try:
+            size = int(content_length)
+        except (TypeError, ValueError):
+            size = 0
+        if size > MAX_REQUEST_BODY:
+            raise ValueError('body too large')
+        self.raw_body = self.rfile.read(size)
+
+    def read_body(self, limit, decoded_limit=MAX_DECODED_BODY):
+        if len(self.raw_body) > limit:
+            raise ValueError('body too large')
+        return decode_body(self.raw_body, self.headers.get('Content-Encoding'), decoded_limit)
+
+    def forward_to_owner(self, key):
+        # Passes the request on to the node owning `key` (a room id or a
+        # pool key), if that isn't us, and relays its answer. Returns
+        # whether it did.
+        if cluster is None or key is None or self.from_node():
+            return False
+        owner = cluster.owner(key)
+        if owner == cluster.self_node:
+            return False
+        self.forwarded = True
+
+        # Browsers send Sec-Fetch-Mode with every request; only navigations
+        # may be sent to another origin.
+        if cluster.redirect and self.headers.get('Sec-Fetch-Mode', 'navigate') == 'navigate':
+            self.send_response_only(HTTPStatus.TEMPORARY_REDIRECT)
+            self.send_header('Location', f'http://{owner}{self.path}')
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return True
+
+        self.relay(owner, self.ask_node(owner))
+        return True
+
+    def from_node(self):
+        return (cluster is not None and CLUSTER_HOP_HEADER in self.headers
+                and self.client_address[0] in cluster.addresses)
+
+    def ask_node(self, node, path=None):
+        # Sends this request, or a GET for `path`, to another node, without
+        # state_lock held while waiting. Returns (status, headers, body);
+        # status None on failure.
+        headers = {name: self.headers[name] for name in CLUSTER_REQUEST_HEADERS if name in self.headers}
+        headers[CLUSTER_HOP_HEADER] = cluster.self_node
+        state_lock.release()
+        try:
+            if path is not None:
+                return cluster.forward(node, 'GET', path, headers, None)
+            return cluster.forward(node, self.command, self.path, headers, self.raw_body)
+        except (OSError, http.client.HTTPException) as e:
+            return None, [], str(e)
+        finally:
+            state_lock.acquire()
+
+    def relay(self, node, response):
+        status, response_headers, body = response
+        if status is None:
+            self.log_message('"%s" => 502 Bad Gateway: %s: %s', self.requestline, node, body)
+            self.send_response_only(HTTPStatus.BAD_GATEWAY)
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return
+        self.send_response_only(status)
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+        for name, value in response_headers:
+            if name.title() in CLUSTER_RESPONSE_HEADERS:
+                self.send_header(name, value)
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def gather_histograms(self, path, merged, count_key):
+        # Adds every other node's histograms from `path` to `merged`.
+        # Returns the nodes that didn't answer.
+        missing = []
+        for node in cluster.ring.nodes:
+            if node == cluster.self_node:
+                continue
+            status, response_headers, body = self.ask_node(node, path)
+            if status == HTTPStatus.OK:
+                encoding = dict((name.title(), value) for name, value in response_headers).get('Content-Encoding')
+                try:
+                    merge_histograms(merged, json.loads(decode_body(body, encoding, MAX_DECODED_BODY)),
+                                     count_key)
+                    continue
+                except (ValueError, TypeError, KeyError, AttributeError) as e:
+                    body = str(e)
+            self.log_message('"%s" => no histograms from %s: %s', self.requestline, node, status or body)
+            missing.append(node)
+        return missing
+
+    def find_on_other_nodes(self):
+        # For lookups that can't be routed by key: relays the first answer
+        # that isn't a 404. Returns whether one was found.
+        if cluster is None or self.from_node():
+            return False
+        for node in cluster.ring.nodes:
+            if node == cluster.self_node:
+                continue
+            response = self.ask_node(node)
+            if response[0] is not None and response[0] != HTTPStatus.NOT_FOUND:
+                self.forwarded = True
+                self.relay(node, response)
+                return True
+        return False
+
+    def admin_authorized(self):
+        token = os.environ.get(ADMIN_TOKEN_ENV)
+        if not token:
             self.not_found()
+            return False
+        scheme, _, credentials = (self.headers.get('Authorization') or '').partition(' ')
+        if scheme.lower() != 'bearer' or not secrets.compare_digest(
+                credentials.strip().encode('utf8'), token.encode('utf8')):
+            self.log_message('"%s" => 401 Unauthorized', self.requestline)
+            self.send_response_only(HTTPStatus.UNAUTHORIZED)
+            self.send_header('WWW-Authenticate', 'Bearer')
+            self.send_header('Content-Length', 0)
+            self.end_headers()
+            return False
+        return True
+
+    def do_admin(self):
+        if not self.admin_authorized():
             return
+        url = urlsplit(self.path)
+        action = (self.command, url.path[len(ADMIN_PATH):].strip('/'))
+        query = parse_qs(url.query)
 
-        self.log_request()
-
-        content_type = 'text/html'
+        def number(name, default, minimum, maximum):
+            value = float(query.get(name, [default])[0])
+            if not math.isfinite(value):
+                raise ValueError(f'invalid {name}')
+            return min(max(value, minimum), maximum)
 
-        if self.path.endswith('/1'):
-            if 2 in offers and 'offer' in offers[2]:
-                content = json.dumps(offers[2]['offer'])
-                content_type = 'application/json'
+        try:
+            if action == ('GET', 'memory'):
+                self.send_json(memory_report())
+            elif action == ('GET', 'profile'):
+                if query.get('format') == ['json']:
+                    self.send_json(profiler.status())
+                else:
+                    self.send_content(profiler.collapsed(), 'text/plain; charset=utf-8')
+            elif action == ('POST', 'profile/start'):
+                interval = number('interval', PROFILE_DEFAULT_INTERVAL, PROFILE_MIN_INTERVAL, 1)
+                duration = number('duration', PROFILE_MAX_DURATION, 0, PROFILE_MAX_DURATION)
+                profiler.start(interval, duration)
+                self.send_json(profiler.status())
+            elif action == ('POST', 'profile/stop'):
+                profiler.stop()
+                self.send_content(profiler.collapsed(), 'text/plain; charset=utf-8')
+            elif action == ('GET', 'tracemalloc'):
+                if not tracemalloc.is_tracing():
+                    raise ValueError('tracemalloc is not running')
+                key_type = query.get('key', ['lineno'])[0]
+                if key_type not in ('lineno', 'filename', 'traceback'):
+                    raise ValueError(f'invalid key: {key_type}')
+                limit = int(number('limit', TRACEMALLOC_DEFAULT_LIMIT, 1, 1000))
+                self.send_json(tracemalloc_report(key_type, limit))
+            elif action == ('POST', 'tracemalloc/start'):
+                frames = int(number('frames', TRACEMALLOC_DEFAULT_FRAMES, 1, 100))
+                tracemalloc_start(frames)
+                self.send_json({'tracing': True, 'frames': tracemalloc.get_traceback_limit()})
+            elif action == ('POST', 'tracemalloc/stop'):
+                tracemalloc_stop()
+                self.send_json({'tracing': False})
             else:
-                content = 'no offer yet'
-                content_type = 'text/plain'
-        elif self.path.endswith('/2'):
-            if 1 in offers and 'offer' in offers[1]:
-                content = json.dumps(offers[1]['offer'])
-                content_type = 'application/json'
+                self.not_found()
+        except ValueError as e:
+            self.bad_request(str(e))
+
+    def get_stats(self):
+        url = urlsplit(self.path)
+        try:
+            tier = int(parse_qs(url.query).get('tier', ['0'])[0])
+        except ValueError:
+            tier = -1
+        if not 0 <= tier < len(STATS_TIERS):
+            self.bad_request('invalid tier')
+            return
+
+        call_id = url.path[len(STATS_PATH) + 1:] or None
+        if call_id is not None:
+            if self.forward_to_owner(as_room_id(call_id)):
+                return
+            summary = stats_summary(call_id, tier)
+            if summary is None:
+                self.not_found()
+                return
+            self.send_json(summary)
+            return
+
+        if parse_qs(url.query).get('format') == ['histogram']:
+            self.send_json(stats_histograms(tier))
+        elif cluster is None or self.from_node():
+            self.send_json(stats_summary(None, tier))
+        else:
+            histograms = stats_histograms(tier)
+            missing = self.gather_histograms(f'{STATS_PATH}?tier={tier}&format=histogram', histograms, 'calls')
+            summary = stats_summary_from_histograms(histograms)
+            if missing:
+                summary['missing_nodes'] = missing
+            self.send_json(summary)
+
+    def post_stats(self):
+        try:
+            data = json.loads(self.read_body(STATS_MAX_BODY, STATS_MAX_DECODED_BODY))
+            if self.forward_to_owner(room_of(data, 'call')):
+                return
+            ingest_stats(data)
+        except (ValueError, AttributeError) as e:
+            self.bad_request(str(e))
+            return
+
+        call_id = str(data['call'])[:64]
+        client_id = str(data.get('id'))[:64]
+        bitrate_controller.report(call_id, client_id, data['samples'])
+        recommendation = bitrate_controller.recommendation(call_id, client_id)
+        if recommendation is not None:
+            self.send_json({'recommendation': recommendation})
+            return
+
+        self.send_response_only(HTTPStatus.NO_CONTENT)
+        self.send_header('Server', self.version_string())
+        self.send_header('Date', self.date_time_string())
+        self.end_headers()
+
+    def get_trace(self):
+        url = urlsplit(self.path)
+        trace_id = url.path[len(TRACE_PATH) + 1:]
+        if not trace_id:
+            if parse_qs(url.query).get('format') == ['histogram']:
+                self.send_json(trace_histograms())
+            elif cluster is None or self.from_node():
+                self.send_json(trace_summary())
             else:
-                content = 'no offer yet'
-                content_type = 'text/plain'
+                histograms = trace_histograms()
+                missing = self.gather_histograms(f'{TRACE_PATH}?format=histogram', histograms, 'traces')
+                summary = trace_summary_from_histograms(histograms)
+                if missing:
+                    summary['missing_nodes'] = missing
+                self.send_json(summary)
+            return
+
+        waterfall = trace_waterfall(trace_id)
+        if waterfall is None:
+            # Traces live with their room, which a trace id doesn't name.
+            if not self.find_on_other_nodes():
+                self.not_found()
+            return
+        if parse_qs(url.query).get('format') == ['text']:
+            self.send_content(format_waterfall(waterfall), 'text/plain; charset=utf-8')
         else:
-            content = render_template()
+            self.send_json({'trace': trace_id, 'spans': waterfall})
 
-        encoded_content = content.encode('utf8')
+    def post_trace(self):
+        try:
+            data = json.loads(self.read_body(TRACE_MAX_BODY))
+            if self.forward_to_owner(room_of(data)):
+                return
+            ingest_trace(data)
+        except (ValueError, AttributeError) as e:
+            self.bad_request(str(e))
+            return
 
-        self.send_response_only(HTTPStatus.OK)
+        self.send_response_only(HTTPStatus.NO_CONTENT)
         self.send_header('Server', self.version_string())
         self.send_header('Date', self.date_time_string())
-        self.send_header('Content-Type', content_type)
-        self.send_header('Content-Length', len(encoded_content))
         self.end_headers()
-        self.wfile.write(encoded_content)
+
+    def post_batch(self):
+        try:
+            data = json.loads(self.read_body(BATCH_MAX_BODY))
+            if self.forward_to_owner(room_of(data)):
+                return
+            response = apply_batch(data)
+        except (ValueError, AttributeError) as e:
+            self.bad_request(str(e))
+            return
+
+        self.send_parts(batch_parts(data['room'], response), 'application/json')
+
+    def do_GET(self):
+        with state_lock:
+            self.handle_get()
 
     def do_POST(self):
+        try:
+            self.receive_body()
+        except ValueError as e:
+            self.bad_request(str(e))
+            return
+        except TimeoutError:
+            self.log_message('"%s" => timed out reading the body', self.requestline)
+            self.close_connection = True
+            return
+        with state_lock:
+            self.handle_post()
+
+    def handle_get(self):
+        if not self.path.startswith(MEETING_PATH):
+            self.not_found()
+            return
+
+        self.log_request()
+
+        path = urlsplit(self.path).path
+        if path == STATS_PATH or path.startswith(STATS_PATH + '/'):
+            self.get_stats()
+            return
+        if path == TRACE_PATH or path.startswith(TRACE_PATH + '/'):
+            self.get_trace()
+            return
+        if path == ADMIN_PATH or path.startswith(ADMIN_PATH + '/'):
+            self.do_admin()
+            return
+        if path == SDP_DICTIONARY_PATH:
+            self.send_encoded(SDP_DICTIONARY, 'application/octet-stream', None)
+            return
+
+        query = parse_qs(urlsplit(self.path).query)
+
+        if path.endswith(('/1', '/2')):
+            try:
+                room_id = int(query.get('room', [''])[0])
+            except ValueError:
+                room_id = None
+            if self.forward_to_owner(room_id):
+                return
+            room = rooms.get(room_id)
+            peer_id = 2 if path.endswith('/1') else 1
+            if room is not None and peer_id in room and 'offer' in room[peer_id]:
+                self.send_offer(room_id, peer_id, room[peer_id]['offer'])
+            else:
+                self.send_content('no offer yet', 'text/plain')
+        else:
+            region = query.get('region', [self.headers.get('X-Region') or 'default'])[0][:32]
+            capability = query.get('capability', ['video'])[0][:32]
+            if self.forward_to_owner(pool_key(region, capability)):
+                return
+            codecs = parse_codecs(query.get('codecs', [''])[0])
+            room_id, client_id = assign_room(region, capability, codecs)
+            parts, self.trace_id = render_template(room_id, client_id)
+            self.send_parts(parts, 'text/html')
+
+    def handle_post(self):
         if not self.path.startswith(MEETING_PATH):
             self.not_found()
             return
 
         self.log_request(with_headers=False)
 
-        content_length = self.headers.get('Content-Length')
-        try:
-            size = int(content_length)
-        except (TypeError, ValueError):
-            size = 0
+        path = urlsplit(self.path).path
+        if path == ADMIN_PATH or path.startswith(ADMIN_PATH + '/'):
+            self.do_admin()
+            return
+        if path == STATS_PATH:
+            self.post_stats()
+            return
+        if path == TRACE_PATH:
+            self.post_trace()
+            return
+        if path == BATCH_PATH:
+            self.post_batch()
+            return
 
-        body = self.rfile.read(size)
+        try:
+            body = self.read_body(BATCH_MAX_BODY)
+        except ValueError as e:
+            self.bad_request(str(e))
+            return
         if body:
-            content_type = self.headers.get('Content-Type')
-            body = body.decode('utf8')
+            content_type = self.headers.get('Content-Type') or ''
+            body = body.decode('utf8', 'replace')
             if content_type.startswith('application/json'):
-                data = json.loads(body)
-                offers[data['id']]['offer'] = data['offer']
-                print(offers.keys())
+                try:
+                    data = json.loads(body)
+                    if self.forward_to_owner(room_of(data)):
+                        return
+                    room_id, room, client_id = find_client(data)
+                    validate_op({'op': 'offer', 'offer': data.get('offer')})
+                except (ValueError, AttributeError) as e:
+                    self.bad_request(str(e))
+                    return
+                post_offer(room, client_id, data['offer'])
+                print(room_id, room.keys())
             else:
                 print(f'{body=}')
 
@@ -548,14 +2829,201 @@ class Handler(BaseHTTPRequestHandler):
         self.wfile.write('finished POST handling'.encode('utf8'))
 
 
+###########
+# RESTART #
+###########
+# On SIGHUP the running process starts a replacement that inherits the
+# listening socket, waits until it has finished starting up, stops accepting,
+# finishes the request in flight and streams a snapshot of `rooms` to it.
+# Connections arriving meanwhile wait in the shared accept backlog.
+SNAPSHOT_MAGIC = b'WRTCSNP1'
+SNAPSHOT_RECORD = struct.Struct('<qI')
+SNAPSHOT_ENV = 'WEBRTC_SNAPSHOT'
+# Set for the replacement only, when no SNAPSHOT_ENV was configured: a file
+# in a private temporary directory, removed once it has been read.
+HANDOFF_SNAPSHOT_ENV = 'WEBRTC_HANDOFF_SNAPSHOT'
+LISTEN_FD_ENV = 'WEBRTC_LISTEN_FD'
+HANDOFF_FD_ENV = 'WEBRTC_HANDOFF_FD'
+HANDOFF_TIMEOUT = 30
+PORT_ENV = 'WEBRTC_PORT'
+SD_LISTEN_FDS_START = 3
+
+
+def save_snapshot(path, sessions):
+    # The snapshot holds every room's SDP, ICE credentials included.
+    tmp_path = f'{path}.tmp'
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with open(fd, 'wb') as f:
+        f.write(SNAPSHOT_MAGIC)
+        for key, value in sessions.items():
+            data = json.dumps(value, separators=(',', ':')).encode('utf8')
+            f.write(SNAPSHOT_RECORD.pack(key, len(data)))
+            f.write(data)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path):
+    sessions = {}
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        if m[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a session snapshot')
+        offset = len(SNAPSHOT_MAGIC)
+        while offset < len(m):
+            key, size = SNAPSHOT_RECORD.unpack_from(m, offset)
+            offset += SNAPSHOT_RECORD.size
+            sessions[key] = json.loads(m[offset:offset + size])
+            offset += size
+    return sessions
+
+
+def inherited_listen_fd():
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd is not None:
+        return int(fd)
+    # systemd socket activation
+    if os.environ.get('LISTEN_PID') == str(os.getpid()) and int(os.environ.get('LISTEN_FDS', 0)) > 0:
+        for name in ('LISTEN_PID', 'LISTEN_FDS', 'LISTEN_FDNAMES'):
+            os.environ.pop(name, None)
+        return SD_LISTEN_FDS_START
+    return None
+
+
+class SignalingServer(ThreadingMixIn, HTTPServer):
+    # A thread per connection, so slow clients and requests waiting on
+    # another cluster node don't hold up the rest; state_lock still
+    # serializes the handlers.
+    def __init__(self, *args, **kwargs):
+        self.waiting = set()
+        self.waiting_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def drop_waiting(self):
+        # On shutdown, connections that haven't sent a request yet (browser
+        # preconnects, say) are closed instead of waited for; clients retry
+        # those on a new connection, which the next process accepts.
+        with self.waiting_lock:
+            for connection in self.waiting:
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+
+def make_server(port):
+    fd = inherited_listen_fd()
+    if fd is None:
+        return SignalingServer(('', port), Handler)
+
+    httpd = SignalingServer(('', port), Handler, bind_and_activate=False)
+    httpd.socket.close()
+    httpd.socket = socket.socket(fileno=fd)
+    httpd.server_address = httpd.socket.getsockname()[:2]
+    httpd.server_name = socket.getfqdn(httpd.server_address[0])
+    httpd.server_port = httpd.server_address[1]
+    return httpd
+
+
+def wait_for_handoff():
+    # Tell the old process we're ready, then wait until it has stopped
+    # serving and written its snapshot. EOF means it went away: just start.
+    fd = os.environ.pop(HANDOFF_FD_ENV, None)
+    if fd is None:
+        return
+    with socket.socket(fileno=int(fd)) as handoff:
+        handoff.sendall(b'R')
+        handoff.recv(1)
+
+
+def start_replacement(httpd):
+    parent_end, child_end = socket.socketpair()
+    env = dict(os.environ)
+    env[LISTEN_FD_ENV] = str(httpd.fileno())
+    env[HANDOFF_FD_ENV] = str(child_end.fileno())
+    snapshot_path = os.environ.get(SNAPSHOT_ENV)
+    if not snapshot_path:
+        snapshot_path = os.path.join(tempfile.mkdtemp(prefix='webrtc_server-'), 'snapshot')
+        env[HANDOFF_SNAPSHOT_ENV] = snapshot_path
+    child = subprocess.Popen([sys.executable] + sys.argv, env=env,
+                             pass_fds=(httpd.fileno(), child_end.fileno()))
+    child_end.close()
+
+    parent_end.settimeout(HANDOFF_TIMEOUT)
+    try:
+        ready = parent_end.recv(1)
+    except OSError:
+        ready = b''
+    if ready != b'R':
+        print(f'Replacement process {child.pid} did not start, keeping this one.')
+        child.kill()
+        parent_end.close()
+        if HANDOFF_SNAPSHOT_ENV in env:
+            os.rmdir(os.path.dirname(snapshot_path))
+        return
+
+    httpd.handoff = (parent_end, snapshot_path)
+    httpd.shutdown()
+
+
 def main(port=8000):
-    with HTTPServer(('', port), Handler) as httpd:
-        print(f'Serving on port {port}...')
+    global cluster
+    port = int(os.environ.get(PORT_ENV, port))
+    with make_server(port) as httpd:
+        httpd.handoff = None
+        cluster = configure_cluster(httpd.server_port)
+        bitrate_controller.estimator = configure_estimator()
+
+        wait_for_handoff()
+        snapshot_path = os.environ.get(SNAPSHOT_ENV)
+        handoff_snapshot_path = os.environ.pop(HANDOFF_SNAPSHOT_ENV, None)
+        restore_path = handoff_snapshot_path or snapshot_path
+        if restore_path and os.path.exists(restore_path):
+            rooms.clear()
+            for room_id, room in load_snapshot(restore_path).items():
+                # JSON turned the client ids into strings.
+                rooms[room_id] = {int(client_id): client for client_id, client in room.items()}
+            restore_matchmaking()
+            os.unlink(restore_path)
+            print(f'Restored {len(rooms)} rooms from {restore_path}')
+        if handoff_snapshot_path:
+            try:
+                os.rmdir(os.path.dirname(handoff_snapshot_path))
+            except OSError:
+                pass
+
+        # The handlers run between requests in the serving thread, which
+        # can't call shutdown() itself.
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=start_replacement, args=(httpd,)).start())
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(
+            target=httpd.shutdown).start())
+
+        print(f'Serving on port {httpd.server_port} (pid {os.getpid()})...')
+        if cluster is not None:
+            print(f'Cluster node {cluster.self_node} of {", ".join(cluster.ring.nodes)}')
+        bitrate_controller.start()
         try:
             httpd.serve_forever()
         except KeyboardInterrupt:
             print("\nKeyboard interrupt received, exiting.")
             sys.exit(0)
+        finally:
+            bitrate_controller.stop()
+        # Let the requests already accepted finish before taking the snapshot.
+        httpd.drop_waiting()
+        httpd.server_close()
+
+        if httpd.handoff is not None:
+            handoff, snapshot_path = httpd.handoff
+            save_snapshot(snapshot_path, rooms)
+            handoff.sendall(b'G')
+            handoff.close()
+            print('Handed over to the replacement process, exiting.')
+        elif snapshot_path:
+            save_snapshot(snapshot_path, rooms)
 
 
 if __name__ == '__main__':
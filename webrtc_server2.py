@@ -7,6 +7,275 @@ import sys
 #############
 # TEMPLATES #
 #############
+# Chunked file transfer over data channels. Kept free of page globals so
+# transfer_bench.py can run it headless under node.
+FILE_TRANSFER_JS = '''
+// Frame header: transfer id (u32), chunk index (u32), SHA-256 of the payload.
+const TRANSFER_HEADER_SIZE = 40;
+const TRANSFER_MAX_CHUNK_SIZE = 64 * 1024;
+const TRANSFER_DEFAULT_MESSAGE_SIZE = 16 * 1024;
+const TRANSFER_LOW_WATER = 1024 * 1024;
+const TRANSFER_HIGH_WATER = 4 * 1024 * 1024;
+const TRANSFER_SETTLE_TIME = 500;
+
+// Picks a chunk size that fits the SCTP max message size including the header.
+function transfer_chunk_size(maxMessageSize) {
+  if (!maxMessageSize || !isFinite(maxMessageSize)) {
+    maxMessageSize = TRANSFER_DEFAULT_MESSAGE_SIZE;
+  }
+  return Math.min(maxMessageSize, TRANSFER_MAX_CHUNK_SIZE) - TRANSFER_HEADER_SIZE;
+}
+
+function bitmap_get(bitmap, i) {
+  return (bitmap[i >> 3] >> (i & 7)) & 1;
+}
+
+function bitmap_set(bitmap, i) {
+  bitmap[i >> 3] |= 1 << (i & 7);
+}
+
+function bitmap_encode(bitmap) {
+  let binary = "";
+  for (let i = 0; i < bitmap.length; i++) {
+    binary += String.fromCharCode(bitmap[i]);
+  }
+  return btoa(binary);
+}
+
+function bitmap_decode(encoded, chunks) {
+  const bitmap = new Uint8Array(Math.ceil(chunks / 8));
+  const binary = atob(encoded || "");
+  for (let i = 0; i < binary.length && i < bitmap.length; i++) {
+    bitmap[i] = binary.charCodeAt(i);
+  }
+  return bitmap;
+}
+
+function bytes_equal(a, b) {
+  if (a.length !== b.length) {
+    return false;
+  }
+  for (let i = 0; i < a.length; i++) {
+    if (a[i] !== b[i]) {
+      return false;
+    }
+  }
+  return true;
+}
+
+async function sha256(data) {
+  return new Uint8Array(await crypto.subtle.digest("SHA-256", data));
+}
+
+// Waits until the channel has drained below its low-water mark.
+function wait_for_drain(channel) {
+  if (channel.bufferedAmount <= TRANSFER_HIGH_WATER) {
+    return Promise.resolve();
+  }
+  return new Promise((resolve, reject) => {
+    const onClose = () => reject(new Error("channel closed during transfer"));
+    channel.addEventListener("bufferedamountlow", () => {
+      channel.removeEventListener("close", onClose);
+      resolve();
+    }, {once: true});
+    channel.addEventListener("close", onClose, {once: true});
+  });
+}
+
+// Sends and receives files. Control messages (JSON strings) go over
+// `control`, chunks are spread over `channels` by lowest bufferedAmount.
+class FileTransfer {
+  constructor(control, channels, maxMessageSize) {
+    this.control = control;
+    this.channels = channels;
+    this.chunkSize = transfer_chunk_size(maxMessageSize);
+    this.waiting = new Map();
+    this.incoming = new Map();
+    this.incomingByKey = new Map();
+    this.onfile = null;
+    this.onprogress = null;
+
+    for (const channel of channels) {
+      channel.binaryType = "arraybuffer";
+      channel.bufferedAmountLowThreshold = TRANSFER_LOW_WATER;
+      channel.addEventListener("message", (event) => this.handleChunk(event.data));
+    }
+    control.addEventListener("message", (event) => this.handleControl(event.data));
+  }
+
+  sendControl(message) {
+    this.control.send(JSON.stringify(message));
+  }
+
+  waitFor(type, id) {
+    const key = type + ":" + id;
+    return new Promise((resolve, reject) => {
+      const onClose = () => {
+        this.waiting.delete(key);
+        reject(new Error("control channel closed during transfer"));
+      };
+      this.control.addEventListener("close", onClose, {once: true});
+      this.waiting.set(key, (message) => {
+        this.control.removeEventListener("close", onClose);
+        resolve(message);
+      });
+    });
+  }
+
+  // Calling send() again with the same file resumes: only chunks the
+  // receiver does not have yet are sent.
+  async send(file) {
+    const chunkSize = this.chunkSize;
+    const chunks = Math.ceil(file.size / chunkSize);
+    const id = crypto.getRandomValues(new Uint32Array(1))[0];
+    const key = [file.name, file.size, file.lastModified].join(":");
+
+    const have = this.waitFor("file-have", id);
+    this.sendControl({type: "file-offer", id: id, key: key, name: file.name,
+                      size: file.size, chunkSize: chunkSize, chunks: chunks});
+    let bitmap = bitmap_decode((await have).bitmap, chunks);
+
+    const digests = new Uint8Array(chunks * 32);
+    let sent = 0;
+    while (true) {
+      for (let i = 0; i < chunks; i++) {
+        const start = i * chunkSize;
+        const payload = new Uint8Array(await file.slice(start, start + chunkSize).arrayBuffer());
+        const digest = await sha256(payload);
+        digests.set(digest, i * 32);
+        if (bitmap_get(bitmap, i)) {
+          continue;
+        }
+
+        const channel = this.channels.reduce(
+          (best, c) => c.bufferedAmount < best.bufferedAmount ? c : best);
+        await wait_for_drain(channel);
+
+        const frame = new Uint8Array(TRANSFER_HEADER_SIZE + payload.length);
+        const view = new DataView(frame.buffer);
+        view.setUint32(0, id);
+        view.setUint32(4, i);
+        frame.set(digest, 8);
+        frame.set(payload, TRANSFER_HEADER_SIZE);
+        channel.send(frame.buffer);
+        sent += payload.length;
+        if (this.onprogress) {
+          this.onprogress(id, sent, file.size);
+        }
+      }
+
+      const done = this.waitFor("file-done", id);
+      this.sendControl({type: "file-end", id: id, root: bitmap_encode(await sha256(digests))});
+      const result = await done;
+      if (result.ok) {
+        return {id: id, sent: sent};
+      }
+      // Chunks that failed verification are missing from the bitmap.
+      bitmap = bitmap_decode(result.bitmap, chunks);
+    }
+  }
+
+  handleControl(data) {
+    if (typeof data !== "string" || !data.startsWith("{")) {
+      return;
+    }
+    let message;
+    try {
+      message = JSON.parse(data);
+    } catch (error) {
+      return;
+    }
+
+    if (message.type === "file-offer") {
+      let state = this.incomingByKey.get(message.key);
+      if (!state || state.chunkSize !== message.chunkSize) {
+        state = {key: message.key, name: message.name, size: message.size,
+                 chunkSize: message.chunkSize, chunks: message.chunks, received: 0,
+                 verifying: 0, lastArrival: 0,
+                 bitmap: new Uint8Array(Math.ceil(message.chunks / 8)),
+                 digests: new Uint8Array(message.chunks * 32),
+                 parts: new Array(message.chunks)};
+        this.incomingByKey.set(message.key, state);
+      }
+      state.lastArrival = Date.now();
+      this.incoming.set(message.id, state);
+      this.sendControl({type: "file-have", id: message.id, bitmap: bitmap_encode(state.bitmap)});
+    } else if (message.type === "file-end") {
+      this.finish(message).catch((error) => {
+        console.log("file transfer error: " + error);
+      });
+    } else {
+      const key = message.type + ":" + message.id;
+      const resolve = this.waiting.get(key);
+      if (resolve) {
+        this.waiting.delete(key);
+        resolve(message);
+      }
+    }
+  }
+
+  async handleChunk(data) {
+    if (!(data instanceof ArrayBuffer) || data.byteLength < TRANSFER_HEADER_SIZE) {
+      return;
+    }
+    const view = new DataView(data);
+    const state = this.incoming.get(view.getUint32(0));
+    const index = view.getUint32(4);
+    if (!state || index >= state.chunks || bitmap_get(state.bitmap, index)) {
+      return;
+    }
+    const expected = new Uint8Array(data, 8, 32);
+    const payload = new Uint8Array(data, TRANSFER_HEADER_SIZE);
+    state.lastArrival = Date.now();
+    state.verifying += 1;
+    const digest = await sha256(payload);
+    state.verifying -= 1;
+    if (!bytes_equal(digest, expected)) {
+      console.log("dropping corrupt chunk", index);
+      return;
+    }
+    // A resent copy may have been verified while this one was hashing.
+    if (bitmap_get(state.bitmap, index)) {
+      return;
+    }
+    state.parts[index] = payload;
+    state.digests.set(expected, index * 32);
+    bitmap_set(state.bitmap, index);
+    state.received += 1;
+  }
+
+  async finish(message) {
+    const state = this.incoming.get(message.id);
+    if (!state) {
+      return;
+    }
+    // file-end can overtake chunks still in flight on the other channels;
+    // wait until they stop arriving before judging the transfer.
+    while (state.verifying > 0 || (state.received < state.chunks &&
+                                   Date.now() - state.lastArrival < TRANSFER_SETTLE_TIME)) {
+      await new Promise((resolve) => setTimeout(resolve, 10));
+    }
+
+    const root = bitmap_encode(await sha256(state.digests));
+    const ok = state.received === state.chunks && root === message.root;
+    if (!ok && state.received === state.chunks) {
+      // Every chunk verified but the manifest does not: start over.
+      state.bitmap.fill(0);
+      state.received = 0;
+    }
+    this.sendControl({type: "file-done", id: message.id, ok: ok,
+                      bitmap: bitmap_encode(state.bitmap)});
+    if (ok) {
+      this.incoming.delete(message.id);
+      this.incomingByKey.delete(state.key);
+      if (this.onfile) {
+        this.onfile(new Blob(state.parts), state.name);
+      }
+    }
+  }
+}
+'''
+
 BASE_TEMPLATE = '''
 <!DOCTYPE html>
 
@@ -20,10 +289,18 @@ BASE_TEMPLATE = '''
   <div id="content">
     <div id="client_id"></div>
 
+    <div id="file_transfer">
+      <input type="file" id="fileInput" />
+      <button id="sendFile">Send File</button>
+      <span id="transferStatus"></span>
+      <a id="receivedFile"></a>
+    </div>
+
     %s
   </div>
 
 <script>
+%s
   const config = {
     iceServers: [{ urls: "stun:stun.l.google.com:19302" }],
   };
@@ -51,11 +328,62 @@ function send_message(msg) {
   }
 }
 
+// Bulk data goes over its own pre-negotiated channels so the control channel
+// never queues behind file chunks.
+const TRANSFER_CHANNELS = 4;
+const transferChannels = [];
+for (let i = 0; i < TRANSFER_CHANNELS; i++) {
+  transferChannels.push(pc.createDataChannel(
+    "MyApp Transfer " + i, {negotiated: true, id: 100 + i, ordered: false}));
+}
+let fileTransfer = null;
+
+function start_file_transfer() {
+  if (fileTransfer !== null) {
+    return;
+  }
+  const maxMessageSize = pc.sctp ? pc.sctp.maxMessageSize : null;
+  fileTransfer = new FileTransfer(dataChannel, transferChannels, maxMessageSize);
+  fileTransfer.onprogress = (id, sent, size) => {
+    document.getElementById("transferStatus").innerText =
+      "sent " + sent + " / " + size + " bytes";
+  };
+  fileTransfer.onfile = (blob, name) => {
+    console.log("received file: ", name, blob.size);
+    const link = document.getElementById("receivedFile");
+    link.href = URL.createObjectURL(blob);
+    link.download = name;
+    link.innerText = "Download " + name;
+  };
+}
+
+function send_file() {
+  const file = document.getElementById("fileInput").files[0];
+  if (!file || fileTransfer === null || dataChannel.readyState !== "open") {
+    console.log("can't send file yet");
+    return;
+  }
+  const started = performance.now();
+  fileTransfer.send(file)
+    .then((result) => {
+      const seconds = (performance.now() - started) / 1000;
+      const rate = (result.sent / (1024 * 1024) / seconds).toFixed(2);
+      document.getElementById("transferStatus").innerText =
+        "sent " + file.name + " at " + rate + " MB/s";
+      log_states(pc, dataChannel);
+    }).catch((error) => {
+      console.log("file transfer error: " + error);
+    });
+}
+
+document.getElementById("sendFile").addEventListener("click", send_file);
+
 function start_data_channel() {
   console.log("starting data channel...");
   dataChannel = pc.createDataChannel("MyApp Channel");
   dataChannel.addEventListener("open", (event) => {
     console.log("channel open!");
+    start_file_transfer();
     send_message("hello world");
   });
   dataChannel.addEventListener("close", (event) => {
@@ -81,6 +409,7 @@ function receiveChannelCallback(event) {
   dataChannel.onopen = handleReceiveChannelStatusChange;
   dataChannel.onclose = handleReceiveChannelStatusChange;
   dataChannel.onerror = handleReceiveChannelStatusChange;
+  start_file_transfer();
 }
 
   %s
@@ -181,7 +510,9 @@ CLIENT_2_JS = '''
   var client_id = 2;
   document.getElementById("client_id").innerText = "Client " + client_id;
 
+  // null if the page was served before client 1 posted its offer.
   let hostOffer = %s;
+  const offerPollInterval = 500;
 
 function handle_ice_candidate(event) {
   console.log("handle_ice_candidate: " + event.candidate);
@@ -220,25 +551,46 @@ function createdAnswer(description) {
   xhr.send(JSON.stringify({"id": client_id, "offer": description}));
 }
 
-  pc.ondatachannel = receiveChannelCallback;
-  pc.setRemoteDescription(hostOffer)
+function accept_offer(offer) {
+  pc.setRemoteDescription(offer)
     .then(() => {
       console.log('set the remote description');
-    }).catch( (error) => {
-        console.log("set remote description error: " + error);
-      }
-    );
-  pc.createAnswer()
+      return pc.createAnswer();
+    })
     .then(createdAnswer)
     .catch( (error) => {
-        console.log("created answer error: " + error);
+        console.log("accept offer error: " + error);
       }
     );
+}
+
+function wait_for_offer() {
+  const xhr = new XMLHttpRequest();
+  xhr.open("GET", "/meet/" + client_id, true);
+  xhr.onreadystatechange = () => {
+    if (xhr.readyState !== XMLHttpRequest.DONE) {
+      return;
+    }
+    if (xhr.status === 200 && xhr.getResponseHeader("Content-Type") === "application/json") {
+      accept_offer(JSON.parse(xhr.responseText));
+    } else {
+      setTimeout(wait_for_offer, offerPollInterval);
+    }
+  };
+  xhr.send();
+}
+
+  pc.ondatachannel = receiveChannelCallback;
+  if (hostOffer !== null) {
+    accept_offer(hostOffer);
+  } else {
+    wait_for_offer();
+  }
 '''
 
 
-CLIENT_1 = BASE_TEMPLATE % (CLIENT_1_HTML, CLIENT_1_JS)
-CLIENT_2 = BASE_TEMPLATE % (CLIENT_2_HTML, CLIENT_2_JS)
+CLIENT_1 = BASE_TEMPLATE % (CLIENT_1_HTML, FILE_TRANSFER_JS, CLIENT_1_JS)
+CLIENT_2 = BASE_TEMPLATE % (CLIENT_2_HTML, FILE_TRANSFER_JS, CLIENT_2_JS)
 
 offers = {0: {}}
 
@@ -250,8 +602,8 @@ def render_template():
         return CLIENT_1
     elif 2 not in offers:
         offers[2] = {}
-        client_2_js = CLIENT_2_JS % json.dumps(offers[1]['offer'])
-        return BASE_TEMPLATE % (CLIENT_2_HTML, client_2_js)
+        client_2_js = CLIENT_2_JS % json.dumps(offers[1].get('offer'))
+        return BASE_TEMPLATE % (CLIENT_2_HTML, FILE_TRANSFER_JS, client_2_js)
     return ''
 
 